@@ -10,8 +10,28 @@
 
 import os
 import argparse
+import bisect
+import builtins
+import codecs
+import collections
+import concurrent.futures
+import contextlib
+import csv
+import difflib
+import functools
+import hashlib
+import io
+import json
+import locale
+import mmap
+import re
 import shutil
 import signal
+import socket
+import sqlite3
+import sys
+import tempfile
+import time
 
 # Constants for section names
 CONSTANTS_SECTION = "Constants"
@@ -20,58 +40,202 @@ KEYSWAP_SECTION = "KeySwap"
 KEYSWAP_ALT_SECTION = "KeySwap_Alt"
 PRESENT_SECTION = "Present"
 CONDITION = "$active == 1 && $submerged == 0 && $underwaterOutfit == 1"
+PATCH_MARKER = ";autoUnderwaterOutfit"
+PATCH_END_MARKER = ";autoUnderwaterOutfit end"
+MERGED_INI_MARKERS = (f"[{KEYSWAP_SECTION}]", SWAPVAR_VARIABLE, f"[{CONSTANTS_SECTION}]")
+UNDO_LOG_FILENAME = "autoUnderwaterOutfit.undo.json"
+PROFILE_REPORT_FILENAME = "autoUnderwaterOutfit.profile.json"
+JOURNAL_FILENAME = "autoUnderwaterOutfit.journal.json"
+STAGED_FILE_PREFIX = ".autoUnderwaterOutfit-"
+ANSWER_CACHE_FILENAME = "autoUnderwaterOutfit.answers.json"
+CATALOG_FILENAME = "autoUnderwaterOutfit.catalog.sqlite"
+DETECTION_LIBRARY_FILENAME = "autoUnderwaterOutfitDetection.ini"
+DETECTION_LIBRARY_NAMESPACE = "autoUnderwaterOutfit"
+# The variable RemoveUnderwaterCensorship global version sets on frames spent in water
+GLOBAL_SUBMERGED_VARIABLE = "$\\global\\submerged\\submerged_start"
+# The same for the shared detection INI of --shared_detection
+SHARED_SUBMERGED_VARIABLE = f"$\\{DETECTION_LIBRARY_NAMESPACE}\\submerged_start"
+SIGNATURE_LINE = "; .ini modified by autoUnderwaterOutfit.py - Created by a4happy20 - https://github.com/a4happy20/autoUnderwaterOutfit"
 TEXTURE_OVERRIDE_HEAD_SECTION = None
 TEXTURE_OVERRIDE_BODY_SECTION = None
 TEXTURE_OVERRIDE_DRESS_SECTION = None
 TEXTURE_OVERRIDE_EXTRA_SECTION = None
 
+# How $swapvar is picked for the selected outfit unless --dispatch says otherwise, see choose_outfit_dispatch
+DEFAULT_DISPATCH = "auto"
+
+# Answers to the questions asked before patching
+PatchSettings = collections.namedtuple("PatchSettings", [
+    "num_outfits",
+    "swapvar_values",
+    "key_toggle",
+    "global_detection",
+    "delay_in_seconds_end",
+    "delay_in_seconds_start",
+    "adjust_key_swap",
+    "idle_guard",
+    "shared_detection",
+    "dispatch",
+], defaults=["n", "n", DEFAULT_DISPATCH])
+
+# Where a section sits in an INI, end is the next header line or the end of the file
+SectionSpan = collections.namedtuple("SectionSpan", ["name", "start_line", "end_line", "start_offset", "end_offset"])
+
+# Where the lines added by an earlier run sit in a patched INI
+PatchedBlocks = collections.namedtuple("PatchedBlocks", ["constants_start", "constants_end", "present_start", "present_end"])
+
+# key/back/type/$swapvar of one INI's [KeySwap] section
+KeySwapValues = collections.namedtuple("KeySwapValues", ["key_swap", "key_back", "key_swap_type", "value_swap"])
+EMPTY_KEYSWAP = KeySwapValues("", "", "", "")
+
+# Outcome of patching one folder in a batch run
+FolderResult = collections.namedtuple("FolderResult", ["folder", "status", "detail", "profile", "diffs"], defaults=[None, None])
+
+# Outcome of patch_ini_text, text has the type of the INI given and is the INI unchanged when error is set
+PatchResult = collections.namedtuple("PatchResult", ["text", "changed", "error"])
+
+# What the catalog knows about one INI, error is None for a merged INI
+CatalogEntry = collections.namedtuple("CatalogEntry", ["path", "size", "mtime_ns", "sha256", "error", "sections", "keyswap_swapvar", "patched_settings"])
+
+def is_ini_filename(filename):
+    return filename.endswith(".ini") and not filename.startswith("DISABLED")
+
+def find_ini_files(script_directory):
+    return [filename for filename in os.listdir(script_directory) if is_ini_filename(filename)]
+
 # Full path to and name of ini file being modified
 def get_ini_files(script_directory):
 
-    ini_files = [filename for filename in os.listdir(script_directory) if filename.endswith(".ini") and not filename.startswith("DISABLED")]
+    ini_files = find_ini_files(script_directory)
 
     if not ini_files:
         print(f"No INI files found at: {script_directory}.")
         exit(1)
     return ini_files
 
-# Error checking for variables and sections in the ini
-def check_ini_file(ini_path):
-    try:
-        with open(ini_path, "r") as ini_file:
-            ini_contents = ini_file.read()
+# First of the markers every merged INI contains that is missing from the raw bytes, None when all are there.
+# The file is memory mapped so nothing is read into Python or decoded.
+def find_missing_ini_marker(ini_path):
+    with open(ini_path, "rb") as ini_file:
+        try:
+            ini_map = mmap.mmap(ini_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files can't be mapped
+            return MERGED_INI_MARKERS[0]
+
+        with ini_map:
+            for marker in MERGED_INI_MARKERS:
+                if ini_map.find(marker.encode()) == -1:
+                    return marker
+    return None
+
+# Checking the variables and sections of an INI read as bytes, returns its texture override sections
+def validate_ini_bytes(ini_bytes, sections):
+    # Same decoding the patch will use when it opens the INI
+    ini_bytes.decode(INI_ENCODING)
+
+    required_variables = [
+        SWAPVAR_VARIABLE,
+    ]
 
-        required_variables = [
-            SWAPVAR_VARIABLE,
-        ]
+    for variable in required_variables:
+        if variable.encode() not in ini_bytes:
+            raise ValueError(f"Error: The INI does not contain a {variable} section.")
 
-        required_sections = [
-            CONSTANTS_SECTION,
-            KEYSWAP_SECTION,
-        ]
+    return validate_ini_sections(sections)
 
-        texture_override_head_section = find_texture_override_head_section(ini_contents)
-        texture_override_body_section = find_texture_override_body_section(ini_contents)
-        texture_override_dress_section = find_texture_override_dress_section(ini_contents)
-        texture_override_extra_section = find_texture_override_extra_section(ini_contents)
+# Checking the sections of an INI, returns its texture override sections
+def validate_ini_sections(sections):
+    required_sections = [
+        CONSTANTS_SECTION,
+        KEYSWAP_SECTION,
+    ]
 
-        for variable in required_variables:
-            if f"{variable}" not in ini_contents:
-                raise ValueError(f"Error: The INI does not contain a {variable} section.")
+    texture_override_head_section = find_texture_override_section(sections, "Head")
+    texture_override_body_section = find_texture_override_section(sections, "Body")
+    texture_override_dress_section = find_texture_override_section(sections, "Dress")
+    texture_override_extra_section = find_texture_override_section(sections, "Extra")
+
+    for section in required_sections:
+        if section not in sections:
+            raise ValueError(f"Error: The INI does not contain a [{section}] section.")
+
+    return (
+        texture_override_head_section,
+        texture_override_body_section,
+        texture_override_dress_section,
+        texture_override_extra_section,
+    )
+
+# The check_ini_file error of an INI read as bytes, None for a merged INI
+def find_ini_bytes_error(ini_bytes, sections):
+    missing_marker = next((marker for marker in MERGED_INI_MARKERS if marker.encode() not in ini_bytes), None)
+    if missing_marker is not None:
+        return f"Error: The INI does not contain a {missing_marker} section."
+    try:
+        validate_ini_bytes(ini_bytes, sections)
+    except ValueError as e:
+        return str(e)
+    return None
 
-        for section in required_sections:
-            if f"[{section}]" not in ini_contents:
-                raise ValueError(f"Error: The INI does not contain a [{section}] section.")
+# Lines of a binary file split like bytes.splitlines, read in blocks so any size fits in memory
+def iter_byte_lines(binary_file, block_size=1024 * 1024):
+    pending_line = b""
+    while True:
+        block = binary_file.read(block_size)
+        if not block:
+            break
+        lines = (pending_line + block).splitlines(keepends=True)
+        # The last line may go on in the next block, or end in the \r of a \r\n split between blocks
+        pending_line = lines.pop()
+        yield from lines
+    if pending_line:
+        yield pending_line
+
+# Passing the lines on while checking they decode like the patch will decode them, raises UnicodeDecodeError
+def decode_checked_lines(lines):
+    decoder = codecs.getincrementaldecoder(INI_ENCODING)()
+    for line in lines:
+        decoder.decode(line)
+        yield line
+    decoder.decode(b"", final=True)
+
+# The sections validate_ini_sections looks at from bytes lines: the required ones and the first texture override
+# of each part, in INI order. Every other section name is dropped so INIs with many sections take no more memory.
+def find_validated_sections(lines):
+    sections = {}
+    texture_override_suffixes = ["Head", "Body", "Dress", "Extra"]
+    for line in lines:
+        first_character = line[:1]
+        if first_character != b"[" and not (first_character.isspace() and line.lstrip().startswith(b"[")):
+            continue
+
+        section_name = parse_section_header(line)
+        if section_name in (CONSTANTS_SECTION, KEYSWAP_SECTION):
+            sections[section_name] = None
+        elif section_name is not None and section_name.startswith("TextureOverride"):
+            for suffix in texture_override_suffixes:
+                if section_name.endswith(suffix):
+                    sections[section_name] = None
+                    texture_override_suffixes.remove(suffix)
+                    break
+    return sections
 
-        return (
-            texture_override_head_section,
-            texture_override_body_section,
-            texture_override_dress_section,
-            texture_override_extra_section,
-        )
+# Error checking for variables and sections in the ini
+def check_ini_file(ini_path, verbose=True):
+    try:
+        # Raw byte scan first, INIs without the markers are never decoded
+        missing_marker = find_missing_ini_marker(ini_path)
+        if missing_marker is not None:
+            raise ValueError(f"Error: The INI does not contain a {missing_marker} section.")
+
+        # The marker scan covered the variables, the sections are checked line by line so memory stays flat
+        with open(ini_path, "rb") as ini_file:
+            return validate_ini_sections(find_validated_sections(decode_checked_lines(iter_byte_lines(ini_file))))
 
     except ValueError as e:
-        print(f"Error: {e}")
+        if verbose:
+            print(f"Error: {e}")
         return False
 
 # Backing up the ini
@@ -116,37 +280,71 @@ def get_user_yes_or_no_input(prompt):
             return yes_or_no_input
         print("Invalid input. Please enter y/n.")
 
-# Making sure the ini still exists
-def add_line_to_ini(ini_path, line_to_add):
-    try:
-        with open(ini_path, "a") as ini_file:
-            ini_file.write("\n" + line_to_add)
-    except FileNotFoundError:
-        print(f"INI file not found: {ini_path}")
-
-# finding the [TextureOverride**Head] section
-def find_texture_override_head_section(ini_contents):
-    for line in ini_contents.splitlines():
-        if line.strip().startswith("[TextureOverride") and line.strip().endswith("Head]"):
-            return line.strip()[1:-1]  # Remove brackets
-
-# finding the [TextureOverride**Body] section
-def find_texture_override_body_section(ini_contents):
-    for line in ini_contents.splitlines():
-        if line.strip().startswith("[TextureOverride") and line.strip().endswith("Body]"):
-            return line.strip()[1:-1]  # Remove brackets
-
-# finding the [TextureOverride**Dress] section
-def find_texture_override_dress_section(ini_contents):
-    for line in ini_contents.splitlines():
-        if line.strip().startswith("[TextureOverride") and line.strip().endswith("Dress]"):
-            return line.strip()[1:-1]  # Remove brackets
-
-# finding the [TextureOverride**Extra] section
-def find_texture_override_extra_section(ini_contents):
-    for line in ini_contents.splitlines():
-        if line.strip().startswith("[TextureOverride") and line.strip().endswith("Extra]"):
-            return line.strip()[1:-1]  # Remove brackets
+# Section name of a header line ("[Name]" -> "Name"), None for an unnamed or non header line
+def parse_section_header(line):
+    stripped = line.strip()
+    if isinstance(stripped, bytes):
+        stripped = stripped.decode("latin-1")
+    if stripped.startswith("[") and stripped.endswith("]"):
+        return stripped[1:-1]
+    return None
+
+# One pass over the lines (str or bytes) collecting every header line and the span of each section.
+# Offsets count the units of the lines, so bytes lines give byte offsets.
+def index_sections(lines):
+    header_lines = []
+    sections = {}
+    section_name = None
+    section_start_line = 0
+    section_start_offset = 0
+    header_mark = b"[" if lines and isinstance(lines[0], bytes) else "["
+    offset = 0
+
+    for i, line in enumerate(lines):
+        # Cheap first character test, most lines are not headers
+        first_character = line[:1]
+        if first_character == header_mark or (first_character.isspace() and line.lstrip().startswith(header_mark)):
+            if section_name is not None:
+                sections[section_name].append(SectionSpan(section_name, section_start_line, i, section_start_offset, offset))
+            header_lines.append(i)
+            section_name = parse_section_header(line)
+            section_start_line = i
+            section_start_offset = offset
+            if section_name is not None:
+                sections.setdefault(section_name, [])
+        offset += len(line)
+
+    if section_name is not None:
+        sections[section_name].append(SectionSpan(section_name, section_start_line, len(lines), section_start_offset, offset))
+
+    return header_lines, sections
+
+# finding the first [TextureOverride**<suffix>] section, e.g. suffix "Head"
+def find_texture_override_section(sections, suffix):
+    for section_name in sections:
+        if section_name.startswith("TextureOverride") and section_name.endswith(suffix):
+            return section_name
+
+# key -> value of the [KeySwap] section, from the text lines of an INI
+def parse_keyswap_section(lines):
+    keyswap_section = {}
+    current_section = None
+
+    for line in lines:
+        line = line.strip()
+
+        if line.startswith('[') and line.endswith(']'):
+            current_section = line[1:-1]  # Remove brackets
+            continue
+
+        if current_section == KEYSWAP_SECTION:
+            parts = line.split('=')
+            if len(parts) == 2:
+                key = parts[0].strip()
+                value = parts[1].strip()
+                keyswap_section[key] = value
+
+    return keyswap_section
 
 def find_keyswap_values(ini_files, script_directory):
     keyswap_values = {}
@@ -155,23 +353,8 @@ def find_keyswap_values(ini_files, script_directory):
         for filename in ini_files:
             ini_path = os.path.join(script_directory, filename)
 
-            keyswap_section = {}
-            current_section = None
-
             with open(ini_path, 'r') as ini_file:
-                for line in ini_file:
-                    line = line.strip()
-
-                    if line.startswith('[') and line.endswith(']'):
-                        current_section = line[1:-1]  # Remove brackets
-                        continue
-
-                    if current_section == KEYSWAP_SECTION:
-                        parts = line.split('=')
-                        if len(parts) == 2:
-                            key = parts[0].strip()
-                            value = parts[1].strip()
-                            keyswap_section[key] = value
+                keyswap_section = parse_keyswap_section(ini_file)
 
             if keyswap_section:  # Check if keyswap_section is not empty
                 keyswap_values[filename] = keyswap_section
@@ -181,307 +364,1145 @@ def find_keyswap_values(ini_files, script_directory):
     except FileNotFoundError:
         print(f"INI file not found: {ini_path}")
 
-# Writing to the ini main
-def add_lines_to_ini_section(ini_path, section_name, lines_to_add):
-    try:
-        with open(ini_path, "r") as ini_file:
-            ini_contents = ini_file.readlines()
-
-        section_start = None
-        section_end = None
+def make_keyswap_values(keyswap_section):
+    return KeySwapValues(
+        keyswap_section.get('key', ''),  # Default to empty string if key is not found
+        keyswap_section.get('back', ''),
+        keyswap_section.get('type', ''),
+        keyswap_section.get(SWAPVAR_VARIABLE, ''),
+    )
+
+# filename -> KeySwapValues, every INI read once
+def build_keyswap_index(ini_files, script_directory):
+    keyswap_values = find_keyswap_values(ini_files, script_directory) or {}
+
+    keyswap_index = {}
+    for filename, keyswap_section in keyswap_values.items():
+        keyswap_index[filename] = make_keyswap_values(keyswap_section)
+    return keyswap_index
+
+# Encoding open() uses for the INI in text mode
+INI_ENCODING = locale.getpreferredencoding(False)
+
+# Unchanged lines can only be copied as raw bytes when the encoding keeps line endings and ASCII as they are
+RAW_SPLICE_ENCODING = "\r\n[]=;$".encode(INI_ENCODING, errors="ignore") == b"\r\n[]=;$"
+
+# Bytes counted in one go while looking for a line
+LINE_OFFSET_BLOCK_SIZE = 1024 * 1024
+
+# Same text open(ini_path, "r") would give
+def decode_ini_bytes(ini_bytes):
+    return ini_bytes.decode(INI_ENCODING).replace("\r\n", "\n").replace("\r", "\n")
+
+# Same bytes open(ini_path, "w") would write, or with the given line ending
+def encode_ini_text(ini_text, newline=None):
+    return ini_text.replace("\n", newline or os.linesep).encode(INI_ENCODING)
+
+# Byte offset each of the ascending line_numbers starts at, with newline as the only line ending in data.
+# Blocks without the line are counted in C, only the last stretch is searched line by line.
+def find_line_offsets(data, newline, line_numbers):
+    offsets = []
+    line = 0
+    position = 0
+    for line_number in line_numbers:
+        while line_number - line > 1:
+            block_end = position + LINE_OFFSET_BLOCK_SIZE
+            # A \r\n is never split over two blocks
+            if len(newline) == 2 and data[block_end - 1:block_end] == newline[:1]:
+                block_end += 1
+            if block_end >= len(data):
+                break
+            block_lines = data.count(newline, position, block_end)
+            if block_lines >= line_number - line:
+                break
+            line += block_lines
+            position = block_end
+
+        while line < line_number:
+            found = data.find(newline, position)
+            if found < 0:
+                # Past the last line ending, only the last line lacking one is left
+                position = len(data)
+                break
+            position = found + len(newline)
+            line += 1
+        offsets.append(position)
+    return offsets
+
+# Writing chunks (bytes or memoryviews) with vectored writes where the platform has them
+def write_chunks(output_file, chunks):
+    chunks = [memoryview(chunk) for chunk in chunks if len(chunk)]
+    raw_file = getattr(output_file, "file", output_file)
+    if not hasattr(os, "writev") or not isinstance(raw_file, io.BufferedIOBase):
+        for chunk in chunks:
+            output_file.write(chunk)
+        return
 
-        for i, line in enumerate(ini_contents):
-            if line.strip() == f"[{section_name}]":
-                section_start = i
+    raw_file.flush()
+    file_descriptor = raw_file.fileno()
+    max_chunks = os.sysconf("SC_IOV_MAX") if "SC_IOV_MAX" in os.sysconf_names else 16
+    while chunks:
+        written = os.writev(file_descriptor, chunks[:max_chunks])
+        # A short write leaves the rest of a chunk for the next call
+        while chunks and written >= len(chunks[0]):
+            written -= len(chunks[0])
+            chunks.pop(0)
+        if written:
+            chunks[0] = chunks[0][written:]
+
+# sha256 of the chunks written one after another
+def hash_chunks(chunks):
+    chunks_hash = hashlib.sha256()
+    for chunk in chunks:
+        chunks_hash.update(chunk)
+    return chunks_hash.hexdigest()
+
+# The line ending used all through the file, None when it mixes several
+def detect_newline(crlf_count, cr_count, lf_count):
+    newlines = [newline for newline, count in (("\r\n", crlf_count), ("\r", cr_count), ("\n", lf_count)) if count]
+    if len(newlines) > 1:
+        return None
+    return newlines[0] if newlines else "\n"
+
+def detect_ini_newline(ini_bytes):
+    crlf_count = ini_bytes.count(b"\r\n")
+    return detect_newline(crlf_count, ini_bytes.count(b"\r") - crlf_count, ini_bytes.count(b"\n") - crlf_count)
+
+# sha256 and line ending of an INI, read in chunks so any size fits in memory
+def hash_ini_file(ini_path):
+    ini_hash = hashlib.sha256()
+    crlf_count = cr_count = lf_count = 0
+    previous_chunk_end = b""
+
+    with open(ini_path, "rb") as ini_file:
+        for chunk in iter(lambda: ini_file.read(1024 * 1024), b""):
+            ini_hash.update(chunk)
+            chunk_crlf_count = chunk.count(b"\r\n")
+            crlf_count += chunk_crlf_count
+            cr_count += chunk.count(b"\r") - chunk_crlf_count
+            lf_count += chunk.count(b"\n") - chunk_crlf_count
+            # A \r\n split over two chunks was counted as one \r and one \n
+            if previous_chunk_end == b"\r" and chunk.startswith(b"\n"):
+                crlf_count += 1
+                cr_count -= 1
+                lf_count -= 1
+            previous_chunk_end = chunk[-1:]
+
+    return ini_hash.hexdigest(), detect_newline(crlf_count, cr_count, lf_count)
+
+# Splitting text the same way readlines() does, keeping the line endings
+def split_lines(text):
+    lines = text.split("\n")
+    last_line = lines.pop()
+    lines = [line + "\n" for line in lines]
+    if last_line:
+        lines.append(last_line)
+    return lines
+
+# INI held in memory so the whole patch is one read and one write
+class IniDocument:
+
+    def __init__(self, lines):
+        self.lines = lines
+        self.modified = False
+        # [start, line count, replaced lines] per edit, undone last to first
+        self.journal = []
+        self.original_sha256 = None
+        self.newline = "\n"
+        # The bytes the lines were read from, unchanged lines are copied from here when saving
+        self.source = None
+        # id of each inserted rendered line -> (inserted lines, rendered lines, index), saved from their cached bytes
+        self.rendered_lines = {}
+        self.original_line_count = len(lines)
+        self.header_lines, section_spans = index_sections(lines)
+        self.sections = {section_name: [span.start_line for span in spans] for section_name, spans in section_spans.items()}
+
+    @classmethod
+    def load(cls, ini_path):
+        with open(ini_path, "rb") as ini_file:
+            ini_bytes = ini_file.read()
+
+        ini_document = cls(split_lines(decode_ini_bytes(ini_bytes)))
+        ini_document.original_sha256 = hashlib.sha256(ini_bytes).hexdigest()
+        ini_document.newline = detect_ini_newline(ini_bytes)
+        ini_document.source = ini_bytes
+        return ini_document
+
+    # The INI as slices of the original bytes for unchanged lines plus the encoded new lines, which get the
+    # line ending of the file. Without one line ending all through the file every line is encoded again.
+    def to_chunks(self):
+        if self.source is None or self.newline is None or not RAW_SPLICE_ENCODING:
+            return [encode_ini_text("".join(self.lines))]
+
+        opcodes = journal_opcodes(self.original_line_count, self.journal)
+        equal_lines = [line for tag, i1, i2, _, _ in opcodes if tag == "equal" for line in (i1, i2)]
+        offsets = iter(find_line_offsets(self.source, self.newline.encode("ascii"), equal_lines))
+        source = memoryview(self.source)
+
+        chunks = []
+        for tag, _, _, j1, j2 in opcodes:
+            if tag == "equal":
+                chunks.append(source[next(offsets):next(offsets)])
+            elif j2 > j1:
+                chunks.extend(self.encode_lines(j1, j2))
+        return chunks
+
+    # Encoding the new lines j1 to j2, runs of rendered lines still in place are sliced from their cached bytes
+    def encode_lines(self, j1, j2):
+        chunks = []
+        start = i = j1
+        while i < j2:
+            rendered = self.rendered_lines.get(id(self.lines[i]))
+            if rendered is None:
+                i += 1
+                continue
+
+            inserted, lines_to_add, first = rendered
+            last = first + 1
+            while last < len(inserted) and i + last - first < j2 and self.lines[i + last - first] is inserted[last]:
+                last += 1
+            if start < i:
+                chunks.append(encode_ini_text("".join(self.lines[start:i]), self.newline))
+            encoded, offsets = encode_rendered_lines(lines_to_add, self.newline)
+            chunks.append(memoryview(encoded)[offsets[first]:offsets[last]])
+            start = i = i + last - first
+        if start < j2:
+            chunks.append(encode_ini_text("".join(self.lines[start:j2]), self.newline))
+        return chunks
+
+    def to_bytes(self):
+        return b"".join(self.to_chunks())
+
+    # Writing the INI, returns the sha256 of what was written
+    def save(self, ini_path):
+        chunks = self.to_chunks()
+        with open(ini_path, "wb") as ini_file:
+            write_chunks(ini_file, chunks)
+        self.modified = False
+        return hash_chunks(chunks)
+
+    # Every edit goes through here so the header index stays in step with the lines
+    def _splice(self, start, end, new_lines):
+        new_lines = split_lines("".join(new_lines))
+        removed_from = bisect.bisect_left(self.header_lines, start)
+        removed_to = bisect.bisect_left(self.header_lines, end)
+
+        for i in self.header_lines[removed_from:removed_to]:
+            section_name = parse_section_header(self.lines[i])
+            if section_name is not None:
+                self.sections[section_name].remove(i)
+                if not self.sections[section_name]:
+                    del self.sections[section_name]
+
+        self.journal.append([start, len(new_lines), self.lines[start:end]])
+        self.lines[start:end] = new_lines
+        self.modified = True
+
+        shift = len(new_lines) - (end - start)
+        if shift:
+            for header_lines in self.sections.values():
+                if header_lines[-1] >= end:
+                    header_lines[:] = [i + shift if i >= end else i for i in header_lines]
+
+        new_header_lines = []
+        for offset, line in enumerate(new_lines):
+            if line.lstrip().startswith("["):
+                new_header_lines.append(start + offset)
+                section_name = parse_section_header(line)
+                if section_name is not None:
+                    bisect.insort(self.sections.setdefault(section_name, []), start + offset)
+
+        self.header_lines[removed_from:] = new_header_lines + [i + shift for i in self.header_lines[removed_to:]]
+
+    def find_section(self, section_name, last=False):
+        header_lines = self.sections.get(section_name)
+        if not header_lines:
+            return None
+        return header_lines[-1] if last else header_lines[0]
+
+    # First header after section_start, or the last line when the section runs to the end of the file
+    def find_section_end(self, section_start):
+        next_header = bisect.bisect_right(self.header_lines, section_start)
+        if next_header < len(self.header_lines):
+            return self.header_lines[next_header]
+        if section_start < len(self.lines) - 1:
+            return len(self.lines) - 1
+        return None
+
+    # First line at or after the section header which begins with prefix
+    def _find_line_after_section(self, section_name, prefix):
+        section_start = self.find_section(section_name)
+        if section_start is None:
+            return None
+
+        for i in range(section_start, len(self.lines)):
+            if self.lines[i].strip().startswith(prefix):
+                return i
+        return None
+
+    # Writing to the ini main
+    def add_lines_to_section(self, section_name, lines_to_add):
+        section_start = self.find_section(section_name)
+        if section_start is None:
+            return
+
+        section_end = self.find_section_end(section_start)
+        if section_end is None:
+            return
+
+        # Find the index of the first comment line (;) or the end of the section
+        comment_line_index = section_start + 1
+        while comment_line_index < section_end:
+            if self.lines[comment_line_index].strip().startswith(";"):
                 break
+            comment_line_index += 1
+
+        # Insert the lines before the first comment line or the end of the section
+        self._splice(comment_line_index, comment_line_index, [line + "\n" for line in lines_to_add])
+        # Rendered lines are cached tuples, their bytes are cached with them. Runs start at a line of more
+        # than one character, Python shares the string of an empty line with every other one.
+        if isinstance(lines_to_add, tuple):
+            inserted = self.lines[comment_line_index:comment_line_index + self.journal[-1][1]]
+            for index, line in enumerate(inserted):
+                if len(line) > 1:
+                    self.rendered_lines[id(line)] = (inserted, lines_to_add, index)
+
+    def ensure_present_section_exists(self, section_name, lines_to_add_present):
+        section_start = self.find_section(section_name, last=True)
 
         if section_start is not None:
-            for i in range(section_start + 1, len(ini_contents)):
-                if ini_contents[i].strip().startswith("[") or i == len(ini_contents) - 1:
+            # Section already exists, find its end
+            section_end = len(self.lines)
+            for i in range(section_start + 1, len(self.lines)):
+                if self.lines[i].strip().startswith("[") or self.lines[i].strip() == "":
                     section_end = i
                     break
 
-            if section_end is not None:
-                # Find the index of the first comment line (;) or the end of the section
-                comment_line_index = section_start + 1
-                while comment_line_index < section_end:
-                    if ini_contents[comment_line_index].strip().startswith(";"):
-                        break
-                    comment_line_index += 1
-
-                # Insert the lines before the first comment line or the end of the section
-                ini_contents = ini_contents[:comment_line_index] + [line + "\n" for line in lines_to_add] + ini_contents[comment_line_index:]
+            # Merge existing lines with lines_to_add_present
+            existing_lines = self.lines[section_start + 1:section_end]
+            merged_lines = existing_lines + list(lines_to_add_present)
+            self._splice(section_start + 1, section_end, [line + "\n" for line in merged_lines])
+        else:
+            # Add [section_name] at the end and add the lines
+            self.append_text(f"\n\n[{section_name}]\n" + "".join(f"{line}\n" for line in lines_to_add_present))
+
+    # Removing specified $swapvar values from [KeySwap_Alt] section
+    def remove_swapvar_values(self, swapvar_values):
+        swapvar_line_index = self._find_line_after_section(KEYSWAP_ALT_SECTION, SWAPVAR_VARIABLE)
+        if swapvar_line_index is None:
+            return
+
+        swapvar_line = self.lines[swapvar_line_index].strip()
+        current_swapvar_values = swapvar_line.split('=')[1].strip().split(',')
+
+        for value in swapvar_values:
+            if str(value) in current_swapvar_values:
+                current_swapvar_values.remove(str(value))
+
+        self._splice(swapvar_line_index, swapvar_line_index + 1, [f"{SWAPVAR_VARIABLE} = {','.join(current_swapvar_values)}\n"])
+
+    def modify_condition_value(self, condition):
+        condition_line_index = self._find_line_after_section(KEYSWAP_SECTION, "condition")
+        if condition_line_index is None:
+            return
+
+        if self.lines[condition_line_index] != f"condition = {condition}\n":
+            self._splice(condition_line_index, condition_line_index + 1, [f"condition = {condition}\n"])
+
+    # Replacing lines[start:end] with new_lines, only the lines that differ are edited
+    def replace_lines(self, start, end, new_lines):
+        new_lines = split_lines("".join(new_lines))
+        matcher = difflib.SequenceMatcher(None, self.lines[start:end], new_lines, autojunk=False)
+        # Last change first so the earlier line numbers stay valid
+        for tag, old_start, old_end, new_start, new_end in reversed(matcher.get_opcodes()):
+            if tag != "equal":
+                self._splice(start + old_start, start + old_end, new_lines[new_start:new_end])
+
+    # Line ranges of the Constants and Present blocks added by an earlier run, None if they are not intact
+    def find_patched_blocks(self):
+        constants_header = self.find_section(CONSTANTS_SECTION)
+        keyswap_alt_header = self.find_section(KEYSWAP_ALT_SECTION)
+        present_header = self.find_section(PRESENT_SECTION, last=True)
+        if constants_header is None or keyswap_alt_header is None or present_header is None:
+            return None
+
+        constants_start = self._find_marker_line(constants_header, keyswap_alt_header)
+        swapvar_line = self._find_line_after_section(KEYSWAP_ALT_SECTION, SWAPVAR_VARIABLE)
+        if constants_start is None or swapvar_line is None:
+            return None
+        # The block ends with the [KeySwap_Alt] $swapvar line and one blank line
+        constants_end = swapvar_line + 2
+
+        present_start = self._find_marker_line(present_header, len(self.lines))
+        if present_start is None:
+            return None
+        # Both layouts end four lines into a section followed by three blank lines
+        present_end = self._find_block_tail(present_start, "CommandListDelayAUO_start")
+        if present_end is not None and present_end + 1 < len(self.lines) and self.lines[present_end + 1].strip() == "[TextureOverrideSwimIcon]":
+            present_end = self._find_block_tail(present_end, "TextureOverrideWaterCensor3")
+        # With shared detection there are no sections, the block ends with its end marker and three blank lines
+        if present_end is None and "CommandListDelayAUO_start" not in self.sections:
+            present_end = self._find_end_marker(present_start)
+
+        if present_end is None or not self._blank_lines(constants_end - 1, constants_end):
+            return None
+        return PatchedBlocks(constants_start, constants_end, present_start, present_end)
+
+    def _find_marker_line(self, start, end):
+        for i in range(start, min(end, len(self.lines))):
+            if self.lines[i].strip() == PATCH_MARKER:
+                return i
+        return None
+
+    def _find_end_marker(self, block_start):
+        for i in range(block_start, len(self.lines)):
+            if self.lines[i].strip() == PATCH_END_MARKER:
+                return i + 4 if self._blank_lines(i + 1, i + 4) else None
+            if parse_section_header(self.lines[i]) is not None:
+                return None
+        return None
+
+    def _find_block_tail(self, block_start, section_name):
+        for header_line in self.sections.get(section_name, []):
+            if header_line > block_start:
+                if self._blank_lines(header_line + 4, header_line + 7):
+                    return header_line + 7
+                return None
+        return None
+
+    def _blank_lines(self, start, end):
+        return end <= len(self.lines) and all(self.lines[i].strip() == "" for i in range(start, end))
+
+    # Same result as appending the text to the file
+    # The journal only holds once saved and read back if every line but the last kept its line ending
+    def undo_delta(self):
+        if self.newline is None or not all(line.endswith("\n") for line in self.lines[:-1]):
+            return None
+        return self.journal
+
+    def append_text(self, text):
+        if self.lines and not self.lines[-1].endswith("\n"):
+            start = len(self.lines) - 1
+            text = self.lines[-1] + text
+        else:
+            start = len(self.lines)
+        self._splice(start, len(self.lines), split_lines(text))
+
+    def add_line(self, line_to_add):
+        self.append_text("\n" + line_to_add)
+
+# Running the whole patch against an already loaded INI
+def apply_underwater_outfit(ini_document, lines_to_add_constants, lines_to_add_present, swapvar_values, adjust_key_swap):
+    ini_document.add_lines_to_section(CONSTANTS_SECTION, lines_to_add_constants)
+    # Check and create [Present] section if needed
+    ini_document.ensure_present_section_exists(PRESENT_SECTION, lines_to_add_present)
+
+    # Removing $swapvar variables if only available underwater
+    if adjust_key_swap in ["yes", "y"]:
+        ini_document.remove_swapvar_values(swapvar_values)
+
+    # Signing and adding the new condition value for [KeySwap]
+    ini_document.add_line(SIGNATURE_LINE)
+    ini_document.modify_condition_value(CONDITION)
+
+
+# Bringing the blocks of an earlier run in line with the new settings.
+# Lines which already match are left alone, so an up to date INI is not modified at all.
+def reapply_underwater_outfit(ini_document, patched_blocks, lines_to_add_constants, lines_to_add_present, swapvar_values, adjust_key_swap):
+    constants_block = IniDocument([line + "\n" for line in lines_to_add_constants])
+    if adjust_key_swap in ["yes", "y"]:
+        constants_block.remove_swapvar_values(swapvar_values)
+    present_block = [line + "\n" for line in lines_to_add_present]
+
+    # Later block first so the line numbers of the other one stay valid
+    blocks = [
+        (patched_blocks.constants_start, patched_blocks.constants_end, constants_block.lines),
+        (patched_blocks.present_start, patched_blocks.present_end, present_block),
+    ]
+    for start, end, new_lines in sorted(blocks, reverse=True):
+        ini_document.replace_lines(start, end, new_lines)
 
-                with open(ini_path, "w") as ini_file:
-                    ini_file.writelines(ini_contents)
+    ini_document.modify_condition_value(CONDITION)
 
-    except FileNotFoundError:
-        print(f"INI file not found: {ini_path}")
+# INIs patched by an earlier run carry a [KeySwap_Alt] section
+def is_patched_ini(ini_path):
+    with open(ini_path, "rb") as ini_file:
+        try:
+            ini_map = mmap.mmap(ini_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            return False
+        with ini_map:
+            return ini_map.find(f"[{KEYSWAP_ALT_SECTION}]".encode()) != -1
+
+# Line positions the streaming patch needs, found in one lazy pass over the original INI
+StreamPlan = collections.namedtuple("StreamPlan", [
+    "constants_insert_line",
+    "present_start_line",
+    "present_end_line",
+    "keyswap_start_line",
+    "condition_line",
+])
+
+def plan_stream_patch(ini_path):
+    line_count = 0
+    constants_start = None
+    constants_end = None
+    constants_comment = None
+    present_start = None
+    present_end = None
+    keyswap_start = None
+    condition_line = None
+
+    with open(ini_path, "r") as ini_file:
+        for i, line in enumerate(ini_file):
+            line_count += 1
+
+            # Only headers, comments, blank lines and condition lines move the plan
+            first_character = line[:1]
+            if first_character not in "[;c" and not first_character.isspace():
+                continue
+
+            stripped = line.strip()
+            is_header = stripped.startswith("[")
+
+            if stripped == f"[{KEYSWAP_ALT_SECTION}]":
+                raise ValueError(f"The INI already contains a [{KEYSWAP_ALT_SECTION}] section.")
+
+            if constants_start is not None and constants_end is None:
+                if is_header:
+                    constants_end = i
+                elif constants_comment is None and stripped.startswith(";"):
+                    constants_comment = i
+            if constants_start is None and stripped == f"[{CONSTANTS_SECTION}]":
+                constants_start = i
+
+            if present_start is not None and present_end is None and (is_header or stripped == ""):
+                present_end = i
+            if stripped == f"[{PRESENT_SECTION}]":
+                present_start = i
+                present_end = None
+
+            if keyswap_start is None and stripped == f"[{KEYSWAP_SECTION}]":
+                keyswap_start = i
+            if keyswap_start is not None and condition_line is None and stripped.startswith("condition"):
+                condition_line = i
+
+    # Same rules as IniDocument.add_lines_to_section, a section running to the end of the file ends at its last line
+    constants_insert_line = None
+    if constants_start is not None:
+        if constants_end is None and constants_start < line_count - 1:
+            constants_end = line_count - 1
+        if constants_end is not None:
+            if constants_comment is not None and constants_comment < constants_end:
+                constants_insert_line = constants_comment
+            else:
+                constants_insert_line = constants_end
+
+    if present_start is not None and present_end is None:
+        present_end = line_count
+
+    return StreamPlan(constants_insert_line, present_start, present_end, keyswap_start, condition_line)
+
+# The patched INI as a generator of text, following the same steps as apply_underwater_outfit.
+# Undo hunks for the changed lines are added to delta as they go past.
+def stream_patched_lines(ini_path, plan, lines_to_add_constants, lines_to_add_present, swapvar_values, adjust_key_swap, delta):
+    condition_line = plan.condition_line
+    constants_block = []
+
+    if plan.constants_insert_line is not None:
+        block = IniDocument([line + "\n" for line in lines_to_add_constants])
+        if adjust_key_swap in ["yes", "y"]:
+            block.remove_swapvar_values(swapvar_values)
+
+        # [KeySwap] above the insertion without its own condition line picks up the first one in the block
+        if plan.keyswap_start_line is not None and plan.keyswap_start_line < plan.constants_insert_line:
+            if condition_line is None or condition_line >= plan.constants_insert_line:
+                condition_line = None
+                for i, line in enumerate(block.lines):
+                    if line.strip().startswith("condition"):
+                        block.lines[i] = f"condition = {CONDITION}\n"
+                        break
 
-# Removing specified $swapvar values from [KeySwap_Alt] section]
-def remove_swapvar_values(ini_path, swapvar_values):
+        constants_block = split_lines("".join(block.lines))
+
+    present_block = [f"{line}\n" for line in lines_to_add_present]
+
+    output_line = 0
+    pending_line = ""
+    pending_original_lines = []
+
+    with open(ini_path, "r") as ini_file:
+        for i, line in enumerate(ini_file):
+            if i == plan.constants_insert_line:
+                add_undo_hunk(delta, output_line, len(constants_block), [])
+                output_line += len(constants_block)
+                yield from constants_block
+
+            original_line = line
+            if i == condition_line:
+                line = f"condition = {CONDITION}\n"
+
+            if plan.present_start_line is not None and plan.present_start_line < i < plan.present_end_line:
+                line += "\n"
+
+            if line.endswith("\n"):
+                if line != original_line:
+                    add_undo_hunk(delta, output_line, line.count("\n"), [original_line])
+                output_line += line.count("\n")
+                yield line
+            else:
+                # Only the last line can lack a line ending, it is written together with the text appended after it
+                pending_line = line
+                pending_original_lines = [original_line]
+
+            if plan.present_start_line is not None and i == plan.present_end_line - 1:
+                if pending_line:
+                    pending_line += "".join(present_block)
+                else:
+                    add_undo_hunk(delta, output_line, len(present_block), [])
+                    output_line += len(present_block)
+                    yield from present_block
+
+    tail = pending_line
+    if plan.present_start_line is None:
+        tail += f"\n\n[{PRESENT_SECTION}]\n" + "".join(present_block)
+    tail += "\n" + SIGNATURE_LINE
+
+    add_undo_hunk(delta, output_line, len(split_lines(tail)), pending_original_lines)
+    yield tail
+
+# Patching with flat memory use, the result is staged in the transaction and replaces the INI when it commits.
+# Returns the undo layer for the change.
+def stream_patch_ini_file(transaction, ini_path, lines_to_add_constants, lines_to_add_present, swapvar_values, adjust_key_swap):
+    original_sha256, newline = hash_ini_file(ini_path)
+    plan = plan_stream_patch(ini_path)
+    delta = []
+    patched_hash = hashlib.sha256()
+    staged_file = transaction.stage(os.path.basename(ini_path))
+
+    # Encoded and written in batches of lines, not one write per line
+    pending_text = []
+    pending_size = 0
+    for text in stream_patched_lines(ini_path, plan, lines_to_add_constants, lines_to_add_present, swapvar_values, adjust_key_swap, delta):
+        pending_text.append(text)
+        pending_size += len(text)
+        if pending_size >= 1024 * 1024:
+            chunk = encode_ini_text("".join(pending_text), newline)
+            patched_hash.update(chunk)
+            staged_file.write(chunk)
+            pending_text = []
+            pending_size = 0
+    chunk = encode_ini_text("".join(pending_text), newline)
+    patched_hash.update(chunk)
+    staged_file.write(chunk)
+
+    backup_path = create_backup(ini_path) if newline is None else None
+    return make_undo_layer(original_sha256, patched_hash.hexdigest(), newline, delta, backup_path)
+
+# Undo log ---------------------------------------------------------------------------------
+# Every patch records a reverse delta in UNDO_LOG_FILENAME next to the INI instead of a full copy:
+# the replaced lines of each edit plus the sha256 of the INI before and after.
+
+def add_undo_hunk(delta, start, count, old_lines):
+    if delta and delta[-1][0] + delta[-1][1] == start:
+        delta[-1][1] += count
+        delta[-1][2].extend(old_lines)
+    else:
+        delta.append([start, count, list(old_lines)])
+
+# INIs that can't be rebuilt from the delta (e.g. mixed line endings) keep a full backup instead
+def make_undo_layer(original_sha256, patched_sha256, newline, delta, backup_path=None):
+    undo_layer = {
+        "original_sha256": original_sha256,
+        "patched_sha256": patched_sha256,
+        "newline": newline,
+        "delta": delta,
+    }
+    if backup_path is not None:
+        undo_layer["backup"] = os.path.basename(backup_path)
+    return undo_layer
+
+# filename -> undo layers, oldest first
+def load_undo_log(script_directory):
+    undo_log_path = os.path.join(script_directory, UNDO_LOG_FILENAME)
     try:
-        with open(ini_path, "r") as ini_file:
-            ini_contents = ini_file.readlines()
-
-        key_swap_alt_section_start = None
-        key_swap_alt_section_end = None
-        swapvar_line_index = None
-
-        for i, line in enumerate(ini_contents):
-            if line.strip() == f"[{KEYSWAP_ALT_SECTION}]":
-                key_swap_alt_section_start = i + 1
-
-            if key_swap_alt_section_start is not None and line.strip().startswith(SWAPVAR_VARIABLE):
-                swapvar_line_index = i
-                break
-
-        if key_swap_alt_section_start is not None:
-            for i in range(key_swap_alt_section_start, len(ini_contents)):
-                if ini_contents[i].strip().startswith("[") or i == len(ini_contents) - 1:
-                    key_swap_alt_section_end = i
-                    break
-
-        if swapvar_line_index is not None and key_swap_alt_section_start is not None and key_swap_alt_section_end is not None:
-            swapvar_line = ini_contents[swapvar_line_index].strip()
-            current_swapvar_values = swapvar_line.split('=')[1].strip().split(',')
-
-            for value in swapvar_values:
-                if str(value) in current_swapvar_values:
-                    current_swapvar_values.remove(str(value))
-
-            ini_contents[swapvar_line_index] = f"{SWAPVAR_VARIABLE} = {','.join(current_swapvar_values)}\n"
-
-            with open(ini_path, "w") as ini_file:
-                ini_file.writelines(ini_contents)
-
+        with open(undo_log_path, "r", encoding="utf-8") as undo_log_file:
+            return json.load(undo_log_file)
     except FileNotFoundError:
-        print(f"INI file not found: {ini_path}")
-
+        return {}
 
-def modify_condition_value(ini_path, CONDITION):
-    try:
-        with open(ini_path, "r") as ini_file:
-            ini_contents = ini_file.readlines()
-
-        key_swap_section_start = None
-        key_swap_section_end = None
-        condition_line_index = None
+def save_undo_log(script_directory, undo_log):
+    undo_log_path = os.path.join(script_directory, UNDO_LOG_FILENAME)
+    if not undo_log:
+        if os.path.exists(undo_log_path):
+            os.remove(undo_log_path)
+        return
 
-        for i, line in enumerate(ini_contents):
-            if line.strip() == f"[{KEYSWAP_SECTION}]":
-                key_swap_section_start = i + 1
+    write_json_file(undo_log_path, undo_log)
+
+# The settings of the patch are kept with its layer, --watch reuses them when the INI is merged again
+def record_undo_layer(undo_log, filename, undo_layer, settings=None):
+    if settings is not None:
+        undo_layer["settings"] = dict(settings._asdict(), swapvar_values=list(settings.swapvar_values))
+
+    undo_layers = undo_log.get(filename, [])
+    # The INI was replaced since the last run (e.g. merged again), the older layers no longer apply
+    if undo_layers and undo_layers[-1]["patched_sha256"] != undo_layer["original_sha256"]:
+        undo_layers = []
+    undo_layers.append(undo_layer)
+    undo_log[filename] = undo_layers
+
+# PatchSettings from the dict saved in JSON, where $swapvar values are a list.
+# Settings saved before there was a dispatch choice always got the if/elif chain.
+def settings_from_json(settings):
+    settings = dict(settings)
+    settings["swapvar_values"] = tuple(settings["swapvar_values"])
+    settings.setdefault("dispatch", "linear")
+    return PatchSettings(**settings)
+
+# The INI bytes from before one undo layer, None if the INI changed since it was patched
+def revert_undo_layer(ini_path, ini_bytes, undo_layer):
+    if hashlib.sha256(ini_bytes).hexdigest() != undo_layer["patched_sha256"]:
+        print(f"Not reverted, the INI changed since it was patched: {ini_path}")
+        return None
+
+    if "backup" in undo_layer:
+        try:
+            with open(os.path.join(os.path.dirname(ini_path), undo_layer["backup"]), "rb") as backup_file:
+                return backup_file.read()
+        except FileNotFoundError:
+            print(f"Backup not found: {undo_layer['backup']}")
+            return None
+
+    lines = split_lines(decode_ini_bytes(ini_bytes))
+    for start, count, old_lines in reversed(undo_layer["delta"]):
+        lines[start:start + count] = old_lines
+
+    original_bytes = "".join(lines).replace("\n", undo_layer["newline"]).encode(INI_ENCODING)
+    if hashlib.sha256(original_bytes).hexdigest() != undo_layer["original_sha256"]:
+        print(f"Not reverted, the original INI could not be rebuilt: {ini_path}")
+        return None
+    return original_bytes
+
+# Reverting the INIs of one folder, either the latest change of each or every recorded change
+def revert_ini_files(script_directory, ini_files, all_layers=False):
+    recover_interrupted_commit(script_directory)
+    undo_log = load_undo_log(script_directory)
+    reverted_files = []
+
+    with IniTransaction(script_directory) as transaction:
+        for filename in ini_files:
+            ini_path = os.path.join(script_directory, filename)
+            undo_layers = undo_log.get(filename, [])
+            if not undo_layers:
+                print(f"Nothing to revert: {ini_path}")
+                continue
 
-            if key_swap_section_start is not None and line.strip().startswith("condition"):
-                condition_line_index = i
-                break
+            with open(ini_path, "rb") as ini_file:
+                ini_bytes = ini_file.read()
 
-        if key_swap_section_start is not None:
-            for i in range(key_swap_section_start, len(ini_contents)):
-                if ini_contents[i].strip().startswith("[") or i == len(ini_contents) - 1:
-                    key_swap_section_end = i
+            while undo_layers:
+                original_bytes = revert_undo_layer(ini_path, ini_bytes, undo_layers[-1])
+                if original_bytes is None:
+                    break
+                if "backup" in undo_layers[-1]:
+                    transaction.remove_after_commit(undo_layers[-1]["backup"])
+                ini_bytes = original_bytes
+                undo_layers.pop()
+                if filename not in reverted_files:
+                    reverted_files.append(filename)
+                if not all_layers:
                     break
 
-        if condition_line_index is not None and key_swap_section_start is not None and key_swap_section_end is not None:
-            ini_contents[condition_line_index] = f"condition = {CONDITION}\n"
+            if not undo_layers:
+                del undo_log[filename]
+            if filename in reverted_files:
+                transaction.stage(filename).write(ini_bytes)
 
-            with open(ini_path, "w") as ini_file:
-                ini_file.writelines(ini_contents)
+        transaction.commit(undo_log)
 
-    except FileNotFoundError:
-        print(f"INI file not found: {ini_path}")
+    for filename in reverted_files:
+        print(f"Reverted: {os.path.join(script_directory, filename)}")
+    return reverted_files
 
+# Transactions -----------------------------------------------------------------------------
+# The new content of every INI of a run is staged in temp files next to them. Commit fsyncs them all,
+# writes JOURNAL_FILENAME naming each staged file and the undo log to save, then renames the staged
+# files over the INIs. A run interrupted before the journal exists is rolled back on the next start
+# (the staged files are deleted, the INIs were never touched), one interrupted after is rolled forward.
 
-def add_underwater_outfit_lines_to_ini_sections(ini_files, script_directory, key_toggle, num_outfits, swapvar_values, outfit_select_values, key_swap, key_back, key_swap_type, value_swap, delay_in_seconds_end, delay_in_seconds_start):
+def fsync_directory(directory):
+    # Directories can't be opened on Windows, there the rename itself is already durable
     try:
-        for filename in ini_files:
-            ini_path = os.path.join(script_directory, filename)
-            lines_to_add_constants, lines_to_add_present = generate_underwater_outfit_lines(key_toggle, num_outfits, swapvar_values, outfit_select_values, key_swap, key_back, key_swap_type, value_swap, delay_in_seconds_end, delay_in_seconds_start)
-            
-            add_lines_to_ini_section(ini_path, CONSTANTS_SECTION, lines_to_add_constants)
-            # Check and create [Present] section if needed
-            ensure_present_section_exists(ini_path, PRESENT_SECTION, lines_to_add_present)
-            
-    except FileNotFoundError:
-        print(f"INI file not found: {ini_path}")
-
-def add_underwater_outfit_lines_to_ini_sections_global(ini_files, script_directory, key_toggle, num_outfits, swapvar_values, outfit_select_values, key_swap, key_back, key_swap_type, value_swap, delay_in_seconds_end, delay_in_seconds_start):
+        directory_fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
     try:
-        for filename in ini_files:
-            ini_path = os.path.join(script_directory, filename)
-            lines_to_add_constants, lines_to_add_present = generate_underwater_outfit_lines_global(key_toggle, num_outfits, swapvar_values, outfit_select_values, key_swap, key_back, key_swap_type, value_swap, delay_in_seconds_end, delay_in_seconds_start)
-            
-            add_lines_to_ini_section(ini_path, CONSTANTS_SECTION, lines_to_add_constants)
-            # Check and create [Present] section if needed
-            ensure_present_section_exists(ini_path, PRESENT_SECTION, lines_to_add_present)
-            
-    except FileNotFoundError:
-        print(f"INI file not found: {ini_path}")
-
-def generate_underwater_outfit_lines(key_toggle, num_outfits, swapvar_values, outfit_select_values, key_swap, key_back, key_swap_type, value_swap, delay_in_seconds_end, delay_in_seconds_start):
-
-    lines_to_add_constants = [
-        ";autoUnderwaterOutfit",
-        "global persist $underwaterOutfit = 0",
-        "global persist $underwaterOutfitSelect = 0",
-        "global persist $submerged = 0",
-        "global persist $submerged_start = 0",
-        "global persist $swapvar_set = 0",
-        "global persist $previousSwapvar = 0",
-        f"global $delayAmount_end = {delay_in_seconds_end}",
-        f"global $delayAmount_start = {delay_in_seconds_start}",
-        "global $delay = 0",
-        "",
-        "",
-        "",
-        ";Underwater Outfit On/Off",
-        "[KeyUnderwaterOutfit]",
-        "condition = $active == 1",
-        f"key = {key_toggle}",
-        "type = cycle",
-        "$underwaterOutfit = 0,1",
-        "",
-    ]
-
-    if num_outfits > 1:
-        lines_to_add_constants.extend([
-            ";Underwater Outfit Cycle",
-            "[KeyUnderwaterOutfitSelect]",
-            "condition = $active == 1 && $submerged == 1",
-        ])
-        if key_swap:
-            lines_to_add_constants.append(f"key = {key_swap}")
-
-        if key_back:
-            lines_to_add_constants.append(f"back = {key_back}")
-        
-        if key_swap_type:
-            lines_to_add_constants.append(f"type = {key_swap_type}")
-
-        lines_to_add_constants.append(f"$underwaterOutfitSelect = {outfit_select_values}\n")
-
-    lines_to_add_constants.extend([
-    ";Key for switching variants when Underwater Outfit is ON",
-    f"[{KEYSWAP_ALT_SECTION}]",
-    "condition = $active == 1 && $submerged == 0 && $underwaterOutfit == 0",
-    f"key = {key_swap}",
-    f"back = {key_back}",
-    f"type = {key_swap_type}",
-    f"{SWAPVAR_VARIABLE} = {value_swap}",
+        os.fsync(directory_fd)
+    except OSError:
+        pass
+    finally:
+        os.close(directory_fd)
+
+# Writing JSON durably: temp file, fsync, rename over the old one
+def write_json_file(json_path, data):
+    directory = os.path.dirname(os.path.abspath(json_path))
+    temp_file = tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=directory, prefix=STAGED_FILE_PREFIX, suffix=".tmp", delete=False)
+    try:
+        with temp_file:
+            json.dump(data, temp_file)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        os.replace(temp_file.name, json_path)
+    except BaseException:
+        os.remove(temp_file.name)
+        raise
+    fsync_directory(directory)
+
+class IniTransaction:
+    def __init__(self, script_directory):
+        self.script_directory = script_directory
+        self.staged_files = []
+        self.removed_files = []
+
+    def __enter__(self):
+        return self
+
+    # Anything still staged on the way out was never committed
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.rollback()
+
+    # A temp file next to the INI for its new content, it replaces the INI on commit
+    def stage(self, filename):
+        ini_path = os.path.join(self.script_directory, filename)
+        staged_file = tempfile.NamedTemporaryFile("wb", dir=self.script_directory, prefix=STAGED_FILE_PREFIX, suffix=".tmp", delete=False)
+        self.staged_files.append((filename, staged_file))
+        if os.path.exists(ini_path):
+            shutil.copymode(ini_path, staged_file.name)
+        return staged_file
+
+    def unstage(self, filename):
+        for staged in [staged for staged in self.staged_files if staged[0] == filename]:
+            staged[1].close()
+            os.remove(staged[1].name)
+            self.staged_files.remove(staged)
+
+    def remove_after_commit(self, filename):
+        self.removed_files.append(filename)
+
+    def commit(self, undo_log):
+        if not self.staged_files and not self.removed_files:
+            return
+
+        for _, staged_file in self.staged_files:
+            staged_file.flush()
+            os.fsync(staged_file.fileno())
+            staged_file.close()
+
+        journal = {
+            "files": [[filename, os.path.basename(staged_file.name)] for filename, staged_file in self.staged_files],
+            "undo_log": undo_log,
+            "remove": self.removed_files,
+        }
+        write_json_file(os.path.join(self.script_directory, JOURNAL_FILENAME), journal)
+        self.staged_files = []
+        self.removed_files = []
+        replay_journal(self.script_directory, journal)
+
+    def rollback(self):
+        for _, staged_file in self.staged_files:
+            staged_file.close()
+            os.remove(staged_file.name)
+        self.staged_files = []
+
+# Renaming the staged files of a committed journal into place, safe to run again after an interrupt
+def replay_journal(script_directory, journal):
+    for filename, staged_filename in journal["files"]:
+        staged_path = os.path.join(script_directory, staged_filename)
+        if os.path.exists(staged_path):
+            os.replace(staged_path, os.path.join(script_directory, filename))
+    fsync_directory(script_directory)
+
+    save_undo_log(script_directory, journal["undo_log"])
+    for filename in journal["remove"]:
+        removed_path = os.path.join(script_directory, filename)
+        if os.path.exists(removed_path):
+            os.remove(removed_path)
+
+    os.remove(os.path.join(script_directory, JOURNAL_FILENAME))
+    fsync_directory(script_directory)
+
+# Finishing or undoing a run that was interrupted in script_directory
+def recover_interrupted_commit(script_directory):
+    journal_path = os.path.join(script_directory, JOURNAL_FILENAME)
+    if os.path.exists(journal_path):
+        with open(journal_path, "r", encoding="utf-8") as journal_file:
+            journal = json.load(journal_file)
+        replay_journal(script_directory, journal)
+        print(f"Finished the changes of an interrupted run in {script_directory}")
+
+    # Staged files without a journal belong to a run that stopped before committing
+    staged_filenames = [filename for filename in os.listdir(script_directory) if filename.startswith(STAGED_FILE_PREFIX) and filename.endswith(".tmp")]
+    for filename in staged_filenames:
+        os.remove(os.path.join(script_directory, filename))
+    if staged_filenames:
+        print(f"Rolled back the unfinished changes of an interrupted run in {script_directory}")
+
+# Template of the lines added to [Constants] and [Present]. The fixed parts are built once here,
+# render_underwater_outfit_lines only fills in the per-mod values.
+PRESENT_STORE_OUTFIT_LINES = (
+    ";autoUnderwater store outfit",
+    "if $underwaterOutfit == 0",
+    "    if $submerged_start == 1 && $submerged == 0 && $swapvar_set == 0",
+    "        run = CommandListDelayAUO_start",
     "",
-    ])
-
-    lines_to_add_present = [
-        ";autoUnderwaterOutfit",
-        "post $submerged_start = 0",
-        "",
-        ";autoUnderwater store outfit",
-        "if $underwaterOutfit == 0",
-        "    if $submerged_start == 1 && $submerged == 0 && $swapvar_set == 0",
-        "        run = CommandListDelayAUO_start",
-        "",
-        "        if time > $delay",
-        f"            $previousSwapvar = {SWAPVAR_VARIABLE}",
-        "            $swapvar_set = 1",
-        "            $submerged = 1",
-        "        endif",
-        "",
-        "    else if $submerged_start == 1 && $submerged == 0 && $swapvar_set == 1",
-        "        $delay = 0",
-        "    endif",
-        "",
-        "    ;autoUnderwater change outfit",
-        "    if $submerged == 1",
-    ]
+    "        if time > $delay",
+    f"            $previousSwapvar = {SWAPVAR_VARIABLE}",
+    "            $swapvar_set = 1",
+    "            $submerged = 1",
+    "        endif",
+    "",
+    "    else if $submerged_start == 1 && $submerged == 0 && $swapvar_set == 1",
+    "        $delay = 0",
+    "    endif",
+    "",
+    "    ;autoUnderwater change outfit",
+    "    if $submerged == 1",
+)
 
-    for i in range(num_outfits):
-        if i == 0:
-            lines_to_add_present.append(f"        if $underwaterOutfitSelect == {i}")
-        else:
-            lines_to_add_present.append(f"        elif $underwaterOutfitSelect == {i}")
+PRESENT_RESTORE_OUTFIT_LINES = (
+    "        endif",
+    "    endif",
+    "",
+    "    ;autoUnderwater reset",
+    "    if $submerged_start == 0",
+    "        $submerged = 0",
+    "    endif",
+    "",
+    "    if $submerged_start == 0 && $swapvar_set == 1",
+    "        run = CommandListDelayAUO_end",
+    "",
+    "    ;autoUnderwater restore outfit",
+    "        if $submerged_start == 0 && $swapvar_set == 1 && time > $delay",
+    f"            {SWAPVAR_VARIABLE} = $previousSwapvar",
+    "            $swapvar_set = 0",
+    "            $delay = 0",
+    "        endif",
+    "    endif",
+    "endif",
+    "",
+    "if time > $delay",
+    "    $delay = 0",
+    "endif",
+)
 
-        lines_to_add_present.append(f"            {SWAPVAR_VARIABLE} = {swapvar_values[i]}")
+PRESENT_DELAY_COMMAND_LISTS = (
+    "",
+    "",
+    "",
+    "[CommandListDelayAUO_end]",
+    "if $delay == 0",
+    "    $delay = time + $delayAmount_end",
+    "endif",
+    "",
+    "[CommandListDelayAUO_start]",
+    "if $delay == 0",
+    "    $delay = time + $delayAmount_start",
+    "endif",
+    "",
+    "",
+    "",
+)
+
+# Only added without global detection, RemoveUnderwaterCensorship global version detects for every mod
+PRESENT_DETECTION_LINES = (
+    ";autoUnderwaterOutfit",
+    "[TextureOverrideSwimIcon]",
+    "hash = 45cbdd97",
+    "match_priority = 99",
+    "$submerged_start = 1",
+    "",
+    ";autoUnderwaterOutfit",
+    "[TextureOverrideSwimDownIcon]",
+    "hash = 46d6aa04",
+    "match_priority = 99",
+    "$submerged_start = 1",
+    "",
+    ";autoUnderwaterOutfit",
+    "[ShaderOverrideWaterCensorWhite]",
+    "hash = 18b644597beb8f8f",
+    "allow_duplicate_hash = true",
+    "if ps-t1 == 102",
+    "    $submerged_start = 1",
+    "endif",
+    "",
+    ";autoUnderwaterOutfit",
+    "[TextureOverrideWaterCensor3]",
+    "hash = 7c897a3a",
+    "match_priority = 99",
+    "filter_index = 102",
+    "",
+    "",
+    "",
+)
 
-    lines_to_add_present.extend([
-        "        endif",
-        "    endif",
-        "",
-        "    ;autoUnderwater reset",
-        "    if $submerged_start == 0",
-        "        $submerged = 0",
-        "    endif",
-        "",
-        "    if $submerged_start == 0 && $swapvar_set == 1",
-        "        run = CommandListDelayAUO_end",
-        "",
-        "    ;autoUnderwater restore outfit",
-        "        if $submerged_start == 0 && $swapvar_set == 1 && time > $delay",
-        f"            {SWAPVAR_VARIABLE} = $previousSwapvar",
-        "            $swapvar_set = 0",
-        "            $delay = 0",
-        "        endif",
-        "    endif",
-        "endif",
-        "",
-        "if time > $delay",
-        "    $delay = 0",
-        "endif",
-        "",
-        "",
-        "",
-        "[CommandListDelayAUO_end]",
+# With shared detection the delay command lists run in place, their variables belong to each mod
+DELAY_COMMAND_LISTS = {
+    "CommandListDelayAUO_end": (
         "if $delay == 0",
         "    $delay = time + $delayAmount_end",
         "endif",
-        "",
-        "[CommandListDelayAUO_start]",
+    ),
+    "CommandListDelayAUO_start": (
         "if $delay == 0",
         "    $delay = time + $delayAmount_start",
         "endif",
-        "",
-        "",
-        "",
-        ";autoUnderwaterOutfit",
-        "[TextureOverrideSwimIcon]",
-        "hash = 45cbdd97",
-        "match_priority = 99",
-        "$submerged_start = 1",
-        "",
-        ";autoUnderwaterOutfit",
-        "[TextureOverrideSwimDownIcon]",
-        "hash = 46d6aa04",
-        "match_priority = 99",
-        "$submerged_start = 1",
-        "",
-        ";autoUnderwaterOutfit",
-        "[ShaderOverrideWaterCensorWhite]",
-        "hash = 18b644597beb8f8f",
-        "allow_duplicate_hash = true",
-        "if ps-t1 == 102",
-        "    $submerged_start = 1",
-        "endif",
-        "",
-        ";autoUnderwaterOutfit",
-        "[TextureOverrideWaterCensor3]",
-        "hash = 7c897a3a",
-        "match_priority = 99",
-        "filter_index = 102",
-        "",
-        "",
-        "",
-    ])
-    
-    return lines_to_add_constants, lines_to_add_present
+    ),
+}
 
+PRESENT_SHARED_DETECTION_END_LINES = (
+    "",
+    PATCH_END_MARKER,
+    "",
+    "",
+    "",
+)
+
+# The one INI every mod patched with shared detection reads $submerged_start from.
+# Its overrides run once per draw however many mods are patched.
+DETECTION_LIBRARY_LINES = (
+    "; Shared water detection for autoUnderwaterOutfit.py - Created by a4happy20 - https://github.com/a4happy20/autoUnderwaterOutfit",
+    f"; Mods patched with --shared_detection read $\\{DETECTION_LIBRARY_NAMESPACE}\\submerged_start, keep this file while any of them is installed.",
+    f"namespace = {DETECTION_LIBRARY_NAMESPACE}",
+    "",
+    f"[{CONSTANTS_SECTION}]",
+    "global $submerged_start = 0",
+    "",
+    f"[{PRESENT_SECTION}]",
+    "post $submerged_start = 0",
+    "",
+    *PRESENT_DETECTION_LINES,
+)
+
+# Replacing each "run = CommandListDelayAUO_*" line with the body of that command list
+def inline_delay_command_lists(lines):
+    inlined_lines = []
+    for line in lines:
+        command = line.strip()
+        command_list = DELAY_COMMAND_LISTS.get(command[len("run = "):]) if command.startswith("run = ") else None
+        if command_list is None:
+            inlined_lines.append(line)
+            continue
+        indent = line[:len(line) - len(line.lstrip())]
+        inlined_lines.extend(f"{indent}{command_list_line}" for command_list_line in command_list)
+    return inlined_lines
+
+# Outfit dispatch --------------------------------------------------------------------------
+# Setting $swapvar from $underwaterOutfitSelect runs on every frame in water. The if/elif chain compares
+# once per outfit, "auto" picks whatever needs the fewest comparisons in the worst case. A selection left
+# over from a run with more outfits still matches no branch, so $swapvar stays unchanged like with the chain.
+
+OUTFIT_DISPATCH_NAMES = {"linear": "if/elif chain", "computed": "computed assignment", "tree": "binary search"}
+
+# The step between the values if they are evenly spaced, None if not
+def arithmetic_step(swapvar_values):
+    if len(swapvar_values) < 2:
+        return None
+    step = swapvar_values[1] - swapvar_values[0]
+    for previous_value, value in zip(swapvar_values, swapvar_values[1:]):
+        if value - previous_value != step:
+            return None
+    return step
+
+# Comparisons of each layout for the worst case selection
+def outfit_dispatch_costs(swapvar_values):
+    num_outfits = len(swapvar_values)
+    costs = {"linear": num_outfits}
+    if arithmetic_step(swapvar_values) is not None:
+        costs["computed"] = 2
+    if num_outfits > 2:
+        costs["tree"] = (num_outfits - 1).bit_length() + 1
+    return costs
+
+# (layout, worst case comparisons), the chain wins ties so small configurations keep their lines
+def choose_outfit_dispatch(swapvar_values, dispatch):
+    costs = outfit_dispatch_costs(swapvar_values)
+    if dispatch == "linear":
+        return "linear", costs["linear"]
+    layout = min(costs, key=lambda layout: (costs[layout], layout != "linear"))
+    return layout, costs[layout]
+
+def describe_outfit_dispatch(settings):
+    layout, comparisons = choose_outfit_dispatch(settings.swapvar_values, settings.dispatch)
+    description = f"Outfit dispatch: {OUTFIT_DISPATCH_NAMES[layout]}, at most {comparisons} comparison(s) per frame in water"
+    if layout != "linear":
+        description += f" (if/elif chain: {len(settings.swapvar_values)})"
+    return description
+
+# Lines picking the outfit, the first one opens an if at the given indent that the caller closes
+def render_outfit_dispatch(swapvar_values, layout, indent="        "):
+    if layout == "computed":
+        step = arithmetic_step(swapvar_values)
+        if step == 0:
+            value = str(swapvar_values[0])
+        else:
+            value = "$underwaterOutfitSelect" if step == 1 else f"$underwaterOutfitSelect * {step}"
+            if swapvar_values[0] > 0:
+                value += f" + {swapvar_values[0]}"
+            elif swapvar_values[0] < 0:
+                value += f" - {-swapvar_values[0]}"
+        return [
+            f"{indent}if $underwaterOutfitSelect >= 0 && $underwaterOutfitSelect < {len(swapvar_values)}",
+            f"{indent}    {SWAPVAR_VARIABLE} = {value}",
+        ]
 
-def generate_underwater_outfit_lines_global(key_toggle, num_outfits, swapvar_values, outfit_select_values, key_swap, key_back, key_swap_type, value_swap, delay_in_seconds_end, delay_in_seconds_start):
+    if layout == "tree":
+        return render_outfit_dispatch_tree(swapvar_values, 0, len(swapvar_values), indent)[:-1]
+
+    lines = []
+    for i, swapvar_value in enumerate(swapvar_values):
+        if i == 0:
+            lines.append(f"{indent}if $underwaterOutfitSelect == {i}")
+        else:
+            lines.append(f"{indent}elif $underwaterOutfitSelect == {i}")
+
+        lines.append(f"{indent}    {SWAPVAR_VARIABLE} = {swapvar_value}")
+    return lines
+
+# Halving the outfits [start, end) until one or two are left, which are then checked for equality
+def render_outfit_dispatch_tree(swapvar_values, start, end, indent):
+    if end - start <= 2:
+        lines = []
+        for i in range(start, end):
+            lines.append(f"{indent}{'if' if i == start else 'elif'} $underwaterOutfitSelect == {i}")
+            lines.append(f"{indent}    {SWAPVAR_VARIABLE} = {swapvar_values[i]}")
+        return [*lines, f"{indent}endif"]
+    middle = (start + end + 1) // 2
+    return [
+        f"{indent}if $underwaterOutfitSelect < {middle}",
+        *render_outfit_dispatch_tree(swapvar_values, start, middle, indent + "    "),
+        f"{indent}else",
+        *render_outfit_dispatch_tree(swapvar_values, middle, end, indent + "    "),
+        f"{indent}endif",
+    ]
+
+# Rendering the lines for one configuration, cached so mods sharing it (e.g. in a batch run) render it once.
+# Returns tuples, copy them before changing them.
+@functools.lru_cache(maxsize=256)
+def render_underwater_outfit_lines(global_detection, key_toggle, num_outfits, swapvar_values, outfit_select_values, key_swap, key_back, key_swap_type, value_swap, delay_in_seconds_end, delay_in_seconds_start, idle_guard=False, shared_detection=False, dispatch=DEFAULT_DISPATCH):
+    # Every outfit needs its own value, a short list would silently drop outfits
+    if len(swapvar_values) != num_outfits:
+        raise ValueError(f"{num_outfits} outfits but {len(swapvar_values)} {SWAPVAR_VARIABLE} values")
+
+    # RemoveUnderwaterCensorship global version already detects once for every mod
+    shared_detection = shared_detection and not global_detection
 
     lines_to_add_constants = [
         ";autoUnderwaterOutfit",
         "global persist $underwaterOutfit = 0",
         "global persist $underwaterOutfitSelect = 0",
         "global persist $submerged = 0",
-        "global persist $submerged_start",
+        "global persist $submerged_start" if global_detection or shared_detection else "global persist $submerged_start = 0",
         "global persist $swapvar_set = 0",
         "global persist $previousSwapvar = 0",
         f"global $delayAmount_end = {delay_in_seconds_end}",
@@ -527,268 +1548,2240 @@ def generate_underwater_outfit_lines_global(key_toggle, num_outfits, swapvar_val
     "",
     ])
 
-    lines_to_add_present = [
-        ";autoUnderwaterOutfit",
-        "if $active == 1",
-        "    $submerged_start = $\global\submerged\submerged_start",
-        "endif",
-        "",
-        ";autoUnderwater store outfit",
-        "if $underwaterOutfit == 0",
-        "    if $submerged_start == 1 && $submerged == 0 && $swapvar_set == 0",
-        "        run = CommandListDelayAUO_start",
-        "",
-        "        if time > $delay",
-        f"            $previousSwapvar = {SWAPVAR_VARIABLE}",
-        "            $swapvar_set = 1",
-        "            $submerged = 1",
-        "        endif",
-        "",
-        "    else if $submerged_start == 1 && $submerged == 0 && $swapvar_set == 1",
-        "        $delay = 0",
-        "    endif",
-        "",
-        "    ;autoUnderwater change outfit",
-        "    if $submerged == 1",
-    ]
+    if global_detection:
+        lines_to_add_present = [
+            ";autoUnderwaterOutfit",
+            "if $active == 1",
+            f"    $submerged_start = {GLOBAL_SUBMERGED_VARIABLE}",
+            "endif",
+            "",
+        ]
+    elif shared_detection:
+        lines_to_add_present = [
+            ";autoUnderwaterOutfit",
+            "if $active == 1",
+            f"    $submerged_start = {SHARED_SUBMERGED_VARIABLE}",
+            "endif",
+            "",
+        ]
+    else:
+        lines_to_add_present = [
+            ";autoUnderwaterOutfit",
+            "post $submerged_start = 0",
+            "",
+        ]
 
-    for i in range(num_outfits):
-        if i == 0:
-            lines_to_add_present.append(f"        if $underwaterOutfitSelect == {i}")
+    frame_lines = list(PRESENT_STORE_OUTFIT_LINES)
+    frame_lines.extend(render_outfit_dispatch(swapvar_values, choose_outfit_dispatch(swapvar_values, dispatch)[0]))
+    frame_lines.extend(PRESENT_RESTORE_OUTFIT_LINES)
+    if shared_detection:
+        frame_lines = inline_delay_command_lists(frame_lines)
+
+    # On dry land with no delay running all of the above changes nothing, one comparison skips it.
+    # The sum is only 0 when all four are, none of them can be negative unless a delay is.
+    if idle_guard:
+        if delay_in_seconds_end >= 0 and delay_in_seconds_start >= 0:
+            lines_to_add_present.append("if $submerged_start + $submerged + $swapvar_set + $delay != 0")
         else:
-            lines_to_add_present.append(f"        elif $underwaterOutfitSelect == {i}")
-
-        lines_to_add_present.append(f"            {SWAPVAR_VARIABLE} = {swapvar_values[i]}")
+            lines_to_add_present.append("if $submerged_start != 0 || $submerged != 0 || $swapvar_set != 0 || $delay != 0")
+        lines_to_add_present.extend(f"    {line}" if line else line for line in frame_lines)
+        lines_to_add_present.append("endif")
+    else:
+        lines_to_add_present.extend(frame_lines)
+
+    if shared_detection:
+        lines_to_add_present.extend(PRESENT_SHARED_DETECTION_END_LINES)
+    else:
+        lines_to_add_present.extend(PRESENT_DELAY_COMMAND_LISTS)
+    if not global_detection and not shared_detection:
+        lines_to_add_present.extend(PRESENT_DETECTION_LINES)
+
+    return tuple(lines_to_add_constants), tuple(lines_to_add_present)
+
+# Writing the shared detection INI to library_directory unless it is already up to date.
+# Replaced in one step so 3DMigoto never loads half of it.
+def write_detection_library(library_directory, dry_run=False):
+    if not os.path.isdir(library_directory):
+        print(f"Error: folder for the shared detection INI not found: {library_directory}")
+        return False
 
-    lines_to_add_present.extend([
-        "        endif",
-        "    endif",
-        "",
-        "    ;autoUnderwater reset",
-        "    if $submerged_start == 0",
-        "        $submerged = 0",
-        "    endif",
-        "",
-        "    if $submerged_start == 0 && $swapvar_set == 1",
-        "        run = CommandListDelayAUO_end",
-        "",
-        "    ;autoUnderwater restore outfit",
-        "        if $submerged_start == 0 && $swapvar_set == 1 && time > $delay",
-        f"            {SWAPVAR_VARIABLE} = $previousSwapvar",
-        "            $swapvar_set = 0",
-        "            $delay = 0",
-        "        endif",
-        "    endif",
-        "endif",
-        "",
-        "if time > $delay",
-        "    $delay = 0",
-        "endif",
-        "",
-        "",
-        "",
-        "[CommandListDelayAUO_end]",
-        "if $delay == 0",
-        "    $delay = time + $delayAmount_end",
-        "endif",
-        "",
-        "[CommandListDelayAUO_start]",
-        "if $delay == 0",
-        "    $delay = time + $delayAmount_start",
-        "endif",
-        "",
-        "",
-        "",
-    ])
-    
-    return lines_to_add_constants, lines_to_add_present
+    library_path = os.path.join(library_directory, DETECTION_LIBRARY_FILENAME)
+    library_bytes = encode_ini_text("\n".join(DETECTION_LIBRARY_LINES) + "\n")
+    try:
+        with open(library_path, "rb") as library_file:
+            if library_file.read() == library_bytes:
+                return False
+    except FileNotFoundError:
+        pass
 
+    if dry_run:
+        print(f"Would write the shared detection INI: {library_path}")
+        return True
 
-def ensure_present_section_exists(ini_path, section_name, lines_to_add_present):
+    temp_file = tempfile.NamedTemporaryFile("wb", dir=library_directory, prefix=STAGED_FILE_PREFIX, suffix=".tmp", delete=False)
     try:
-        with open(ini_path, "r") as ini_file:
-            ini_contents = ini_file.readlines()
+        with temp_file:
+            temp_file.write(library_bytes)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        os.replace(temp_file.name, library_path)
+    except BaseException:
+        os.remove(temp_file.name)
+        raise
+    fsync_directory(library_directory)
+    print(f"Shared detection INI written: {library_path}")
+    return True
+
+# Settings patching with shared detection need the library, the global version of RemoveUnderwaterCensorship replaces it
+def uses_detection_library(settings):
+    return settings.shared_detection in ["yes", "y"] and settings.global_detection not in ["yes", "y"]
+
+# Asking for anything not given on the command line or saved for the mod in cached_settings
+def get_patch_settings(args, cached_settings=None):
+    if cached_settings is not None:
+        args = apply_cached_answers(args, cached_settings)
+
+    if args.num_outfits is None:
+        num_outfits = get_user_integer_input("How many Underwater Outfits do you have? (e.g., 'Number'):\n")
+    else:
+        num_outfits = args.num_outfits
+
+    if args.swapvar_values is None:
+        swapvar_values = []
+        for i in range(num_outfits):
+            swapvar_value = get_user_integer_input(f"Enter the value of {SWAPVAR_VARIABLE} for Underwater Outfit {i + 1} (e.g., 'Number'):\n")
+            swapvar_values.append(swapvar_value)
+    else:
+        swapvar_values = args.swapvar_values
+
+    if args.toggle_key is None:
+        key_toggle = get_user_key_input("Enter a key for toggling auto underwater outfit (e.g., 'Number, Letter, or Special Key (VK_RIGHT)'):\n")
+    else:
+        key_toggle = args.toggle_key
+
+    if args.global_detection is None:
+        global_detection = get_user_key_input("Are you using RemoveUnderwaterCensorship global version? (yes/no):\n")
+    else:
+        global_detection = args.global_detection
+
+    if args.delay_end is None:
+        delay_in_seconds_end = 9.75
+    else:
+        delay_in_seconds_end = args.delay_end
+
+    if args.delay_start is None:
+        delay_in_seconds_start = 0.00
+    else:
+        delay_in_seconds_start = args.delay_start
+
+    if args.aks is None:
+        adjust_key_swap = get_user_yes_or_no_input("Do you want the Underwater Outfits to only be available when you are underwater or if functionality is toggled off? (yes/no):\n").strip().lower()
+    else:
+        adjust_key_swap = args.aks
+
+    # Output modes, never asked for since the INI behaves the same either way
+    idle_guard = "n" if args.idle_guard is None else args.idle_guard
+    shared_detection = "n" if args.shared_detection is None else args.shared_detection
+    dispatch = DEFAULT_DISPATCH if args.dispatch is None else args.dispatch
+
+    return PatchSettings(num_outfits, tuple(swapvar_values), key_toggle, global_detection, delay_in_seconds_end, delay_in_seconds_start, adjust_key_swap, idle_guard, shared_detection, dispatch)
+
+# The bytes of rendered lines with the line ending of an INI and the offset each of their lines starts at,
+# cached so a batch run encodes each block once
+@functools.lru_cache(maxsize=256)
+def encode_rendered_lines(lines, newline):
+    encoded_lines = [encode_ini_text(line, newline) for line in split_lines("".join(f"{line}\n" for line in lines))]
+    offsets = [0]
+    for encoded_line in encoded_lines:
+        offsets.append(offsets[-1] + len(encoded_line))
+    return b"".join(encoded_lines), offsets
+
+# The lines to add to one INI, with the values of its own [KeySwap].
+# --profile times the generation here, wrapping the cached render would hide cache_info and cache_clear.
+def render_lines_for_ini(settings, keyswap):
+    start = time.perf_counter()
+    outfit_select_values = ",".join(map(str, range(settings.num_outfits)))
+    rendered_lines = render_underwater_outfit_lines(settings.global_detection in ["yes", "y"], settings.key_toggle, settings.num_outfits, settings.swapvar_values, outfit_select_values, keyswap.key_swap, keyswap.key_back, keyswap.key_swap_type, keyswap.value_swap, settings.delay_in_seconds_end, settings.delay_in_seconds_start, settings.idle_guard in ["yes", "y"], settings.shared_detection in ["yes", "y"], settings.dispatch)
+    if PROFILER is not None:
+        PROFILER.add_stage("generation", time.perf_counter() - start)
+    return rendered_lines
+
+# Patching a loaded INI in memory, updating the blocks of an earlier run if there are any.
+# False if those blocks were changed by hand and can't be found anymore.
+def patch_ini_document(ini_document, settings, lines_to_add_constants, lines_to_add_present):
+    swapvar_values = list(settings.swapvar_values)
+    if ini_document.find_section(KEYSWAP_ALT_SECTION) is None:
+        apply_underwater_outfit(ini_document, lines_to_add_constants, lines_to_add_present, swapvar_values, settings.adjust_key_swap)
+        return True
+
+    patched_blocks = ini_document.find_patched_blocks()
+    if patched_blocks is None:
+        return False
+    reapply_underwater_outfit(ini_document, patched_blocks, lines_to_add_constants, lines_to_add_present, swapvar_values, settings.adjust_key_swap)
+    return True
 
-        present_section_found = False
-        shader_line_index = None
-        overrides_line_index = None
+# Adding autoUnderwaterOutfit to the INIs of one folder, returns the INIs written
+def patch_ini_files(script_directory, ini_files, settings, stream=False):
+    recover_interrupted_commit(script_directory)
 
-        for i, line in enumerate(ini_contents):
-            if line.strip() == f"[{section_name}]":
-                present_section_found = True
-                section_start = i
+    swapvar_values = list(settings.swapvar_values)
 
-        if present_section_found:
-            # Section already exists, find its end
-            section_end = None
-            for i in range(section_start + 1, len(ini_contents)):
-                if ini_contents[i].strip().startswith("[") or ini_contents[i].strip() == "":
-                    section_end = i
-                    break
-            if section_end is None:
-                section_end = len(ini_contents)
+    # Extract values from the KeySwap section, once per INI
+    keyswap_index = build_keyswap_index(ini_files, script_directory)
 
-            # Extract existing lines within the section
-            existing_lines = ini_contents[section_start + 1:section_end]
+    # One read per INI, each with the values of its own [KeySwap]. The new content is staged and
+    # every changed INI is replaced at once when the transaction commits.
+    undo_log = load_undo_log(script_directory)
+    written_files = []
+    with IniTransaction(script_directory) as transaction:
+        for filename in ini_files:
+            ini_path = os.path.join(script_directory, filename)
 
-            # Merge existing lines with lines_to_add_present
-            lines_to_add_present = existing_lines + lines_to_add_present
-
-            # Replace lines within the section with the merged lines
-            ini_contents[section_start + 1:section_end] = [line + "\n" for line in lines_to_add_present]
-        elif shader_line_index is not None:
-            # Add the [section_name] and lines before the ; Shader line
-            ini_contents.insert(shader_line_index, f"[{section_name}]\n")
-            ini_contents = (
-                ini_contents[:shader_line_index + 1] +
-                [line + "\n" for line in lines_to_add_present] +
-                ini_contents[shader_line_index + 1:]
-            )
-        elif overrides_line_index is not None:
-            # Add the [section_name] and lines before the ; Overrides line
-            ini_contents.insert(overrides_line_index, f"[{section_name}]\n")
-            ini_contents = (
-                ini_contents[:overrides_line_index + 1] +
-                [line + "\n" for line in lines_to_add_present] +
-                ini_contents[overrides_line_index + 1:]
-            )
+            # Adds autoUnderwaterOutfit
+            lines_to_add_constants, lines_to_add_present = render_lines_for_ini(settings, keyswap_index.get(filename, EMPTY_KEYSWAP))
+
+            try:
+                # An INI patched by an earlier run always goes through the document so its blocks can be updated in place
+                if stream and not is_patched_ini(ini_path):
+                    undo_layer = stream_patch_ini_file(transaction, ini_path, lines_to_add_constants, lines_to_add_present, swapvar_values, settings.adjust_key_swap)
+                    record_undo_layer(undo_log, filename, undo_layer, settings)
+                    written_files.append(filename)
+                    continue
+
+                ini_document = IniDocument.load(ini_path)
+                if not patch_ini_document(ini_document, settings, lines_to_add_constants, lines_to_add_present):
+                    print(f"Error: {ini_path} was already modified but its autoUnderwaterOutfit lines were changed by hand. Restore the original INI first.")
+                    continue
+
+                if not ini_document.modified:
+                    print(f"Unchanged: {ini_path}")
+                    continue
+
+                delta = ini_document.undo_delta()
+                backup_path = create_backup(ini_path) if delta is None else None
+                chunks = ini_document.to_chunks()
+                write_chunks(transaction.stage(filename), chunks)
+                patched_sha256 = hash_chunks(chunks)
+                record_undo_layer(undo_log, filename, make_undo_layer(ini_document.original_sha256, patched_sha256, ini_document.newline, delta or [], backup_path), settings)
+                written_files.append(filename)
+            except FileNotFoundError:
+                transaction.unstage(filename)
+                print(f"INI file not found: {ini_path}")
+            except ValueError as e:
+                transaction.unstage(filename)
+                print(f"Error: {ini_path}: {e}")
+
+        transaction.commit(undo_log)
+
+    return written_files
+
+# Library API ------------------------------------------------------------------------------
+# patch_ini_text runs the whole patch on an INI held in memory, for tools that import this script:
+#   result = autoUnderwaterOutfit.patch_ini_text(ini_bytes, autoUnderwaterOutfit.PatchSettings(2, (1, 2), "VK_F7", "n", 9.75, 0.0, "y"))
+# Nothing is read, written, printed or asked. Bytes are decoded like an INI file and come back with their own
+# line endings and unchanged lines as they were, text comes back as text.
+
+def patch_ini_text(ini_text, settings):
+    settings = settings._replace(swapvar_values=tuple(settings.swapvar_values))
+
+    if isinstance(ini_text, (bytes, bytearray, memoryview)):
+        ini_bytes = bytes(ini_text)
+        try:
+            ini_document = IniDocument(split_lines(decode_ini_bytes(ini_bytes)))
+        except UnicodeDecodeError as e:
+            return PatchResult(ini_bytes, False, str(e))
+        ini_document.newline = detect_ini_newline(ini_bytes)
+        ini_document.source = ini_bytes
+    else:
+        # Checked as the bytes it would be saved as, characters the INI encoding lacks don't matter in memory
+        ini_bytes = ini_text.encode(INI_ENCODING, errors="replace")
+        ini_document = IniDocument(split_lines(ini_text.replace("\r\n", "\n").replace("\r", "\n")))
+        crlf_count = ini_text.count("\r\n")
+        ini_document.newline = detect_newline(crlf_count, ini_text.count("\r") - crlf_count, ini_text.count("\n") - crlf_count)
+
+    error = find_ini_bytes_error(ini_bytes, ini_document.sections)
+    if error is not None:
+        return PatchResult(ini_text, False, error)
+
+    lines_to_add_constants, lines_to_add_present = render_lines_for_ini(settings, make_keyswap_values(parse_keyswap_section(ini_document.lines)))
+    if not patch_ini_document(ini_document, settings, lines_to_add_constants, lines_to_add_present):
+        return PatchResult(ini_text, False, "The INI was already modified but its autoUnderwaterOutfit lines were changed by hand.")
+    if not ini_document.modified:
+        return PatchResult(ini_text, False, None)
+
+    if ini_document.source is not None:
+        return PatchResult(ini_document.to_bytes(), True, None)
+    return PatchResult("".join(ini_document.lines).replace("\n", ini_document.newline or "\n"), True, None)
+
+# Answer cache -----------------------------------------------------------------------------
+# The answers given for a mod are saved in ANSWER_CACHE_FILENAME next to its INIs with a hash of their structure.
+# Later runs on the same mod take them from there, until merging changes its sections or [KeySwap] $swapvar.
+
+# PatchSettings field -> command line argument
+SETTINGS_ARGUMENTS = (
+    ("num_outfits", "num_outfits"),
+    ("swapvar_values", "swapvar_values"),
+    ("key_toggle", "toggle_key"),
+    ("global_detection", "global_detection"),
+    ("delay_in_seconds_end", "delay_end"),
+    ("delay_in_seconds_start", "delay_start"),
+    ("adjust_key_swap", "aks"),
+    ("idle_guard", "idle_guard"),
+    ("shared_detection", "shared_detection"),
+    ("dispatch", "dispatch"),
+)
+
+# The arguments get_patch_settings asks for when they are missing, the others have defaults
+PROMPTED_ARGUMENTS = ("num_outfits", "swapvar_values", "toggle_key", "global_detection", "aks")
+
+# Sections this script adds, patching a mod doesn't change its structure
+GENERATED_SECTIONS = frozenset([
+    # Only added to INIs without one, so it is left out whether the mod had it or not
+    PRESENT_SECTION,
+    "KeyUnderwaterOutfit",
+    "KeyUnderwaterOutfitSelect",
+    KEYSWAP_ALT_SECTION,
+    "CommandListDelayAUO_end",
+    "CommandListDelayAUO_start",
+    "TextureOverrideSwimIcon",
+    "TextureOverrideSwimDownIcon",
+    "ShaderOverrideWaterCensorWhite",
+    "TextureOverrideWaterCensor3",
+])
+
+# The flags that were given, the saved answers for the rest
+def apply_cached_answers(args, cached_settings):
+    given_num_outfits = args.num_outfits is not None
+    given_swapvar_values = args.swapvar_values is not None
+
+    args = argparse.Namespace(**vars(args))
+    for field, argument in SETTINGS_ARGUMENTS:
+        if getattr(args, argument) is None:
+            setattr(args, argument, getattr(cached_settings, field))
+
+    # A new number of outfits needs new values and new values set the number of outfits
+    if given_num_outfits and not given_swapvar_values and len(args.swapvar_values) != args.num_outfits:
+        args.swapvar_values = None
+    elif given_swapvar_values and not given_num_outfits:
+        args.num_outfits = len(args.swapvar_values)
+    return args
+
+# The $swapvar values set in the [KeySwap] sections of an INI read as bytes lines
+def find_keyswap_swapvar(lines, sections):
+    swapvar_values = []
+    for section_span in sections.get(KEYSWAP_SECTION, []):
+        for line in lines[section_span.start_line + 1:section_span.end_line]:
+            key, _, value = line.partition(b"=")
+            if key.strip() == SWAPVAR_VARIABLE.encode("ascii"):
+                swapvar_values.append(value.strip())
+    return swapvar_values
+
+# The section names in the order they first appear and the [KeySwap] $swapvar values of INI bytes lines,
+# the same as index_sections and find_keyswap_swapvar without keeping the lines
+def find_ini_structure(lines):
+    section_names = {}
+    swapvar_values = []
+    swapvar_key = SWAPVAR_VARIABLE.encode("ascii")
+    section_name = None
+    for line in lines:
+        first_character = line[:1]
+        if first_character == b"[" or (first_character.isspace() and line.lstrip().startswith(b"[")):
+            section_name = parse_section_header(line)
+            if section_name is not None:
+                section_names[section_name] = None
+        elif section_name == KEYSWAP_SECTION:
+            key, _, value = line.partition(b"=")
+            if key.strip() == swapvar_key:
+                swapvar_values.append(value.strip())
+    return section_names, swapvar_values
+
+# sha256 over the section names (without ours) and [KeySwap] $swapvar of every INI in the folder.
+# With a catalog only the INIs that changed since it saw them are read, without one each INI is read line by line.
+def hash_ini_structure(script_directory, ini_files, catalog=None):
+    structure_hash = hashlib.sha256()
+    for filename in sorted(ini_files):
+        ini_path = os.path.join(script_directory, filename)
+        if catalog is not None:
+            catalog_entry = catalog.lookup(ini_path)
+            section_names = catalog_entry.sections
+            swapvar_values = [value.encode("latin-1") for value in catalog_entry.keyswap_swapvar]
         else:
-            # Add [section_name] at the end and add the lines
-            ini_contents.append(f"\n\n[{section_name}]\n")
-            ini_contents.extend([f"{line}\n" for line in lines_to_add_present])
-
-        with open(ini_path, "w") as ini_file:
-            ini_file.writelines(ini_contents)
-
+            with open(ini_path, "rb") as ini_file:
+                section_names, swapvar_values = find_ini_structure(iter_byte_lines(ini_file))
+
+        structure_hash.update(filename.encode("utf-8") + b"\0")
+        for section_name in section_names:
+            if section_name not in GENERATED_SECTIONS:
+                structure_hash.update(section_name.encode("utf-8") + b"\n")
+
+        for value in swapvar_values:
+            structure_hash.update(b"$swapvar=" + value + b"\n")
+    return structure_hash.hexdigest()
+
+def save_cached_answers(script_directory, ini_files, settings):
+    write_json_file(os.path.join(script_directory, ANSWER_CACHE_FILENAME), {
+        "structure": hash_ini_structure(script_directory, ini_files),
+        "settings": settings._asdict(),
+    })
+
+# The answers saved for the mod in script_directory, None if there are none or its INIs changed structure since
+def load_cached_answers(script_directory, ini_files, catalog=None):
+    try:
+        with open(os.path.join(script_directory, ANSWER_CACHE_FILENAME), "r", encoding="utf-8") as cache_file:
+            answer_cache = json.load(cache_file)
+        if answer_cache["structure"] != hash_ini_structure(script_directory, ini_files, catalog):
+            return None
+        return settings_from_json(answer_cache["settings"])
     except FileNotFoundError:
-        print(f"INI file not found: {ini_path}")
-
-def main():
-    parser = argparse.ArgumentParser(description="Add autoUnderwaterOutfit Lines to your ini file.")
-    parser.add_argument("--num_outfits", type=int, help="Number of Underwater Outfits.")
-    parser.add_argument("--swapvar_values", nargs='+', type=int, help=f"Values of {SWAPVAR_VARIABLE} for each Underwater Outfit.")
-    parser.add_argument("--toggle_key", type=str, help="Key for toggling auto underwater outfit on/off.")
-    parser.add_argument("--global_detection", type=str, choices=["y", "n"], help="Are you using RemoveUnderwaterCensorship global version? (yes/no)")
-    parser.add_argument("--delay_end", type=float, help="Set the delayAmount in seconds for switching the outfit after leaving water.")
-    parser.add_argument("--delay_start", type=float, help="Set the delayAmount in seconds for switching the outfit when entering water.")
-    parser.add_argument("--aks", type=str, choices=["y", "n"], help="Do you want the Underwater Outfits to only be available when you are underwater or if functionality is toggled off.")
-    
-    args = parser.parse_args()
+        return None
+    except (ValueError, KeyError, TypeError):
+        print(f"Ignoring unreadable saved answers: {os.path.join(script_directory, ANSWER_CACHE_FILENAME)}")
+        return None
+
+def has_cached_answers(script_directory):
+    return os.path.isfile(os.path.join(script_directory, ANSWER_CACHE_FILENAME))
+
+# The INIs of folder that are not merged INIs, from the catalog when there is one
+def find_invalid_ini_files(folder, catalog=None):
+    ini_files = find_ini_files(folder)
+    if catalog is None:
+        return [filename for filename in ini_files if not check_ini_file(os.path.join(folder, filename), verbose=False)]
+    return [filename for filename in ini_files if catalog.lookup(os.path.join(folder, filename)).error is not None]
+
+# folder -> PatchSettings for a batch run. Folders with saved answers use them under the flags given,
+# the others share one set of answers asked once. Folders with invalid INIs are left out, run_batch skips
+# them, so nothing is asked for them.
+def resolve_batch_settings(folders, args, catalog=None):
+    folder_settings = {}
+    uncached_folders = []
+    for folder in folders:
+        cached_settings = load_cached_answers(folder, find_ini_files(folder), catalog)
+        if cached_settings is not None:
+            folder_settings[folder] = get_patch_settings(args, cached_settings)
+        elif not find_invalid_ini_files(folder, catalog):
+            uncached_folders.append(folder)
+
+    if folder_settings:
+        print(f"Using saved answers for {len(folder_settings)} of {len(folders)} folders")
+    if uncached_folders:
+        settings = get_patch_settings(args)
+        print(describe_outfit_dispatch(settings))
+        folder_settings.update(dict.fromkeys(uncached_folders, settings))
+    return folder_settings
+
+# Catalog ----------------------------------------------------------------------------------
+# A --root run keeps what it learned about every INI below root in CATALOG_FILENAME (SQLite): size, mtime and
+# sha256, whether it is a merged INI, its sections and [KeySwap] $swapvar and the settings it is patched with.
+# Later runs stat the INIs and only read the ones that changed. Folders whose INIs are all patched with the
+# settings of the run are not opened at all.
+
+# Bumped when the table changes, an older catalog is started over
+CATALOG_VERSION = 1
+
+# An INI changed this recently is hashed again next time, its mtime can't show a change later in the same tick
+CATALOG_RACY_SECONDS = 2
+
+# What the catalog keeps about the content of an INI: why it is not a merged INI (None if it is),
+# its section names and the $swapvar values of its [KeySwap] (bytes decoded as latin-1)
+def describe_ini_bytes(ini_bytes):
+    lines = ini_bytes.splitlines(keepends=True)
+    _, sections = index_sections(lines)
+    keyswap_swapvar = tuple(value.decode("latin-1") for value in find_keyswap_swapvar(lines, sections))
+    return find_ini_bytes_error(ini_bytes, sections), tuple(sections), keyswap_swapvar
+
+def catalog_row(catalog_entry):
+    patched_settings = None if catalog_entry.patched_settings is None else json.dumps(catalog_entry.patched_settings._asdict())
+    return (catalog_entry.path, catalog_entry.size, catalog_entry.mtime_ns, catalog_entry.sha256, catalog_entry.error,
+            json.dumps(catalog_entry.sections), json.dumps(catalog_entry.keyswap_swapvar), patched_settings)
+
+def catalog_entry_from_row(row):
+    path, size, mtime_ns, sha256, error, sections, keyswap_swapvar, patched_settings = row
+    patched_settings = None if patched_settings is None else settings_from_json(json.loads(patched_settings))
+    return CatalogEntry(path, size, mtime_ns, sha256, error, tuple(json.loads(sections)), tuple(json.loads(keyswap_swapvar)), patched_settings)
+
+class ModCatalog:
+    def __init__(self, catalog_path, read_only=False):
+        self.catalog_path = catalog_path
+        self.read_only = read_only
+        self.connection = sqlite3.connect(catalog_path)
+        # INI path -> CatalogEntry, every row is loaded at once instead of one query per INI
+        self.entries = {}
+        if self.connection.execute("PRAGMA user_version").fetchone()[0] == CATALOG_VERSION:
+            self.entries = {row[0]: catalog_entry_from_row(row) for row in self.connection.execute("SELECT * FROM ini_files")}
+        elif not read_only:
+            self.connection.executescript(f"""
+                DROP TABLE IF EXISTS ini_files;
+                CREATE TABLE ini_files (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, sha256 TEXT, error TEXT,
+                                        sections TEXT, keyswap_swapvar TEXT, patched_settings TEXT);
+                PRAGMA user_version = {CATALOG_VERSION};
+            """)
+        # Paths checked against the disk in this run and the ones whose entry has to be saved
+        self.checked_paths = set()
+        self.changed_paths = set()
+        # folder -> undo log, read once per folder with a changed INI
+        self.undo_logs = {}
+        self.read_count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if not self.read_only:
+                self.save()
+        except sqlite3.Error as e:
+            print(f"Could not update the catalog {self.catalog_path}: {e}")
+        finally:
+            self.connection.close()
+
+    # The entry of an INI, up to date with the file. Only an INI whose size or mtime changed is read.
+    # The marker scan of check_ini_file comes first, an INI without them is kept by size and mtime only
+    # and never hashed or indexed.
+    def lookup(self, ini_path):
+        catalog_entry = self.entries.get(ini_path)
+        if ini_path in self.checked_paths:
+            return catalog_entry
+
+        ini_stat = os.stat(ini_path)
+        if catalog_entry is None or catalog_entry.size != ini_stat.st_size or catalog_entry.mtime_ns != ini_stat.st_mtime_ns:
+            mtime_ns = ini_stat.st_mtime_ns if time.time_ns() - ini_stat.st_mtime_ns >= CATALOG_RACY_SECONDS * 1_000_000_000 else 0
+            missing_marker = find_missing_ini_marker(ini_path)
+            if missing_marker is not None:
+                catalog_entry = CatalogEntry(ini_path, ini_stat.st_size, mtime_ns, None, f"Error: The INI does not contain a {missing_marker} section.", (), (), None)
+            else:
+                with open(ini_path, "rb") as ini_file:
+                    ini_bytes = ini_file.read()
+                self.read_count += 1
+
+                sha256 = hashlib.sha256(ini_bytes).hexdigest()
+                # Touched but not changed (e.g. copied back), only the patched state is looked up again
+                if catalog_entry is None or catalog_entry.sha256 != sha256:
+                    catalog_entry = CatalogEntry(ini_path, 0, 0, sha256, *describe_ini_bytes(ini_bytes), None)
+                catalog_entry = catalog_entry._replace(size=ini_stat.st_size, mtime_ns=mtime_ns, patched_settings=self.find_patched_settings(ini_path, sha256))
+            self.entries[ini_path] = catalog_entry
+            self.changed_paths.add(ini_path)
+
+        self.checked_paths.add(ini_path)
+        return catalog_entry
+
+    # The settings of the last patch of the INI, if the INI is still exactly what that patch wrote
+    def find_patched_settings(self, ini_path, sha256):
+        folder, filename = os.path.split(ini_path)
+        if folder not in self.undo_logs:
+            try:
+                self.undo_logs[folder] = load_undo_log(folder)
+            except ValueError:
+                self.undo_logs[folder] = {}
+
+        undo_layers = self.undo_logs[folder].get(filename)
+        if not undo_layers or undo_layers[-1]["patched_sha256"] != sha256 or "settings" not in undo_layers[-1]:
+            return None
+        return settings_from_json(undo_layers[-1]["settings"])
+
+    def is_merged_ini(self, ini_path):
+        try:
+            return self.lookup(ini_path).error is None
+        except OSError:
+            return False
 
-    # Error checking
-    script_directory = os.path.dirname(os.path.abspath(__file__))
-    ini_files = get_ini_files(script_directory)
+    # The result of patching folder with settings when the catalog already knows it: skipped for invalid INIs,
+    # unchanged when every INI is patched with these settings. None when the folder has to be patched.
+    def folder_result(self, folder, settings):
+        try:
+            ini_files = find_ini_files(folder)
+            catalog_entries = [self.lookup(os.path.join(folder, filename)) for filename in ini_files]
+        except OSError:
+            return None
+
+        invalid_ini_files = [filename for filename, catalog_entry in zip(ini_files, catalog_entries) if catalog_entry.error is not None]
+        if invalid_ini_files:
+            return FolderResult(folder, "skipped", f"invalid INI files: {', '.join(invalid_ini_files)}")
+        if ini_files and all(catalog_entry.patched_settings == settings for catalog_entry in catalog_entries):
+            return FolderResult(folder, "unchanged", f"{len(ini_files)} INI file(s) already up to date")
+        return None
+
+    # Everything is checked against the disk again, for a process that serves many runs
+    def start_over(self):
+        self.checked_paths.clear()
+        self.undo_logs.clear()
+
+    # Writing the changed entries and dropping the ones of INIs that are gone
+    def save(self):
+        removed_paths = [path for path in self.entries if path not in self.checked_paths and not os.path.exists(path)]
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO ini_files VALUES (?, ?, ?, ?, ?, ?, ?, ?)", [catalog_row(self.entries[path]) for path in self.changed_paths])
+            self.connection.executemany("DELETE FROM ini_files WHERE path = ?", [(path,) for path in removed_paths])
+        for path in removed_paths:
+            del self.entries[path]
+        self.changed_paths.clear()
+
+# The catalog of root_directory for a batch run, or a context giving None when it is turned off or can't be used.
+# A dry run never creates or updates it.
+def open_mod_catalog(root_directory, enabled=True, dry_run=False):
+    catalog_path = os.path.join(root_directory, CATALOG_FILENAME)
+    if not enabled or (dry_run and not os.path.isfile(catalog_path)):
+        return contextlib.nullcontext()
 
-    invalid_ini_files = [filename for filename in ini_files if not check_ini_file(os.path.join(script_directory, filename))]
+    try:
+        return ModCatalog(catalog_path, read_only=dry_run)
+    except sqlite3.OperationalError as e:
+        print(f"Not using the catalog {catalog_path}: {e}")
+        return contextlib.nullcontext()
+    except sqlite3.DatabaseError:
+        if dry_run:
+            return contextlib.nullcontext()
+        # It only repeats what the INIs say, so a damaged catalog is simply built again
+        print(f"Starting over with an unreadable catalog: {catalog_path}")
+        os.remove(catalog_path)
+        return ModCatalog(catalog_path)
+
+# Dry run ----------------------------------------------------------------------------------
+# The patch is computed in memory and shown as a unified diff, nothing is opened for writing.
+# The diff comes from the document's journal of edits, so no line by line comparison of the whole INI is needed.
+
+# (tag, i1, i2, j1, j2) like SequenceMatcher.get_opcodes, from the original line count and the journal of edits
+def journal_opcodes(original_count, journal):
+    # The patched INI as runs of original lines [start, end) and runs of new lines (None, count),
+    # so the cost follows the number of edits and not the length of the INI
+    runs = [(0, original_count)] if original_count else []
+    for start, count, old_lines in journal:
+        first = split_run(runs, start)
+        last = split_run(runs, start + len(old_lines))
+        runs[first:last] = [(None, count)] if count else []
+
+    opcodes = []
+    i = j = 0
+    new_count = 0
+    for run_start, run_end in runs + [(original_count, original_count)]:
+        if run_start is None:
+            new_count += run_end
+            continue
+
+        # New lines and the original lines dropped before this run
+        if new_count or run_start > i:
+            tag = "replace" if new_count and run_start > i else ("insert" if new_count else "delete")
+            opcodes.append((tag, i, run_start, j, j + new_count))
+            j += new_count
+            new_count = 0
+
+        if run_end > run_start:
+            if opcodes and opcodes[-1][0] == "equal" and opcodes[-1][2] == run_start:
+                opcodes[-1] = ("equal", opcodes[-1][1], run_end, opcodes[-1][3], j + run_end - run_start)
+            else:
+                opcodes.append(("equal", run_start, run_end, j, j + run_end - run_start))
+            j += run_end - run_start
+        i = max(i, run_end)
+    return opcodes
+
+# Making line a run boundary, returns the index of the run starting there
+def split_run(runs, line):
+    position = 0
+    for index, (run_start, run_end) in enumerate(runs):
+        run_length = run_end if run_start is None else run_end - run_start
+        if position == line:
+            return index
+        if line < position + run_length:
+            offset = line - position
+            if run_start is None:
+                runs[index:index + 1] = [(None, offset), (None, run_end - offset)]
+            else:
+                runs[index:index + 1] = [(run_start, run_start + offset), (run_start + offset, run_end)]
+            return index + 1
+        position += run_length
+    return len(runs)
+
+# Hunks of opcodes with context lines around the changes, as in difflib's unified_diff
+def group_opcodes(opcodes, context=3):
+    if not opcodes:
+        return []
+
+    opcodes = list(opcodes)
+    tag, i1, i2, j1, j2 = opcodes[0]
+    if tag == "equal":
+        opcodes[0] = tag, max(i1, i2 - context), i2, max(j1, j2 - context), j2
+    tag, i1, i2, j1, j2 = opcodes[-1]
+    if tag == "equal":
+        opcodes[-1] = tag, i1, min(i2, i1 + context), j1, min(j2, j1 + context)
+
+    groups = []
+    group = []
+    for tag, i1, i2, j1, j2 in opcodes:
+        if tag == "equal" and i2 - i1 > context * 2:
+            group.append((tag, i1, min(i2, i1 + context), j1, min(j2, j1 + context)))
+            groups.append(group)
+            group = []
+            i1, j1 = max(i1, i2 - context), max(j1, j2 - context)
+        group.append((tag, i1, i2, j1, j2))
+    if group and not (len(group) == 1 and group[0][0] == "equal"):
+        groups.append(group)
+    return groups
+
+def format_hunk_range(start, stop):
+    length = stop - start
+    if length == 1:
+        return f"{start + 1}"
+    if not length:
+        return f"{start},0"
+    return f"{start + 1},{length}"
+
+def format_diff_line(prefix, line):
+    if line.endswith("\n"):
+        return prefix + line
+    return f"{prefix}{line}\n\\ No newline at end of file\n"
+
+# Unified diff between the lines an INI was loaded with and its patched document
+def format_unified_diff(filename, original_lines, ini_document, context=3):
+    diff_lines = [f"--- a/{filename}\n", f"+++ b/{filename}\n"]
+    new_lines = ini_document.lines
+
+    for group in group_opcodes(journal_opcodes(len(original_lines), ini_document.journal), context):
+        diff_lines.append(f"@@ -{format_hunk_range(group[0][1], group[-1][2])} +{format_hunk_range(group[0][3], group[-1][4])} @@\n")
+        for tag, i1, i2, j1, j2 in group:
+            if tag == "equal":
+                diff_lines.extend(format_diff_line(" ", line) for line in original_lines[i1:i2])
+                continue
+            diff_lines.extend(format_diff_line("-", line) for line in original_lines[i1:i2])
+            diff_lines.extend(format_diff_line("+", line) for line in new_lines[j1:j2])
+
+    return "".join(diff_lines)
+
+# The diff of every INI of one folder that would change, as (filename, diff).
+# The diff names the INIs relative to diff_root if given.
+def preview_ini_files(script_directory, ini_files, settings, diff_root=None):
+    keyswap_index = build_keyswap_index(ini_files, script_directory)
+    diffs = []
+
+    for filename in ini_files:
+        ini_path = os.path.join(script_directory, filename)
+        lines_to_add_constants, lines_to_add_present = render_lines_for_ini(settings, keyswap_index.get(filename, EMPTY_KEYSWAP))
 
-    if invalid_ini_files:
-        print("INFO: This script will only work on INI files generated by genshin_merge_mods.py")
-        print("Invalid INI files:")
-        for invalid_file in invalid_ini_files:
-            print(invalid_file)
+        try:
+            ini_document = IniDocument.load(ini_path)
+            original_lines = list(ini_document.lines)
+            if not patch_ini_document(ini_document, settings, lines_to_add_constants, lines_to_add_present):
+                print(f"Error: {ini_path} was already modified but its autoUnderwaterOutfit lines were changed by hand. Restore the original INI first.")
+                continue
+
+            if not ini_document.modified:
+                print(f"Unchanged: {ini_path}")
+                continue
+
+            label = filename if diff_root is None else os.path.relpath(ini_path, diff_root).replace(os.sep, "/")
+            diffs.append((filename, format_unified_diff(label, original_lines, ini_document)))
+        except FileNotFoundError:
+            print(f"INI file not found: {ini_path}")
+        except ValueError as e:
+            print(f"Error: {ini_path}: {e}")
+
+    return diffs
+
+# Printing the diffs, or saving them all to one patch file
+def output_diffs(diffs, diff_output=None):
+    if diff_output is None:
+        for _, diff in diffs:
+            print(diff, end="")
         return
 
+    with open(diff_output, "w", encoding="utf-8", newline="") as diff_file:
+        for _, diff in diffs:
+            diff_file.write(diff)
+    print(f"Diff of {len(diffs)} INI file(s) written to {diff_output}")
 
+# Quiet version of check_ini_file for scanning many folders
+def is_merged_ini(ini_path):
     try:
-        # User inputs
-        if args.num_outfits is None:
-            num_outfits = get_user_integer_input("How many Underwater Outfits do you have? (e.g., 'Number'):\n")
-        else:
-            num_outfits = args.num_outfits
+        return bool(check_ini_file(ini_path, verbose=False))
+    except OSError:
+        return False
 
-        if args.swapvar_values is None:
-            swapvar_values = []
-            for i in range(num_outfits):
-                swapvar_value = get_user_integer_input(f"Enter the value of {SWAPVAR_VARIABLE} for Underwater Outfit {i + 1} (e.g., 'Number'):\n")
-                swapvar_values.append(swapvar_value)
-        else:
-            swapvar_values = args.swapvar_values
+# Every folder below root_directory holding an INI generated by genshin_merge_mods.py
+def find_merged_mod_folders(root_directory, catalog=None):
+    merged_mod_folders = []
+    is_merged = is_merged_ini if catalog is None else catalog.is_merged_ini
 
-        if args.toggle_key is None:
-            key_toggle = get_user_key_input("Enter a key for toggling auto underwater outfit (e.g., 'Number, Letter, or Special Key (VK_RIGHT)'):\n")
-        else:
-            key_toggle = args.toggle_key
+    for directory, subdirectories, filenames in os.walk(root_directory):
+        subdirectories[:] = sorted(subdirectory for subdirectory in subdirectories if not subdirectory.startswith("DISABLED"))
 
-        if args.global_detection is None:
-            global_detection = get_user_key_input("Are you using RemoveUnderwaterCensorship global version? (yes/no):\n")
-        else:
-            global_detection = args.global_detection
+        for filename in filenames:
+            if is_ini_filename(filename) and is_merged(os.path.join(directory, filename)):
+                merged_mod_folders.append(directory)
+                # The variants inside a merged mod are never patched on their own
+                subdirectories[:] = []
+                break
 
-        for filename in ini_files:
-            ini_path = os.path.join(script_directory, filename)
-            find_keyswap_values(ini_files, script_directory)
+    return merged_mod_folders
 
-            # Extract values from the KeySwap section
-            ini_files = get_ini_files(script_directory)
-            keyswap_values = find_keyswap_values(ini_files, script_directory)
+# Patching one folder of a batch run, any error stays in that folder's result
+def patch_folder(script_directory, settings, stream=False, profile=False, dry_run=False, diff_root=None):
+    if not profile:
+        return check_and_patch_folder(script_directory, settings, stream, dry_run, diff_root)
 
-            for filename, keyswap_section in keyswap_values.items():
-                key_swap = keyswap_section.get('key', '')  # Default to empty string if key is not found
-                key_back = keyswap_section.get('back', '')
-                key_swap_type = keyswap_section.get('type', '')
-                value_swap = keyswap_section.get(SWAPVAR_VARIABLE, '')
+    # Each folder gets its own profile, batch workers send it back with the result
+    previous_profiler = start_profiling()
+    try:
+        result = check_and_patch_folder(script_directory, settings, stream, dry_run, diff_root)
+    finally:
+        folder_profile = stop_profiling(previous_profiler)
+    return result._replace(profile=folder_profile)
 
-        if args.delay_end is None:
-            delay_in_seconds_end = 9.75
-        else:
-            delay_in_seconds_end = args.delay_end
+def check_and_patch_folder(script_directory, settings, stream, dry_run=False, diff_root=None):
+    output = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(output):
+            ini_files = find_ini_files(script_directory)
+            invalid_ini_files = [filename for filename in ini_files if not check_ini_file(os.path.join(script_directory, filename))]
+            if invalid_ini_files:
+                return FolderResult(script_directory, "skipped", f"invalid INI files: {', '.join(invalid_ini_files)}")
+
+            if dry_run:
+                diffs = preview_ini_files(script_directory, ini_files, settings, diff_root)
+                if not diffs:
+                    return FolderResult(script_directory, "unchanged", f"{len(ini_files)} INI file(s) already up to date")
+                return FolderResult(script_directory, "patched", f"{len(diffs)} of {len(ini_files)} INI file(s) would change", diffs=diffs)
+
+            written_files = patch_ini_files(script_directory, ini_files, settings, stream)
+            save_cached_answers(script_directory, ini_files, settings)
+
+        if not written_files:
+            return FolderResult(script_directory, "unchanged", f"{len(ini_files)} INI file(s) already up to date")
+        return FolderResult(script_directory, "patched", f"{len(written_files)} of {len(ini_files)} INI file(s) written")
+
+    except Exception as e:
+        return FolderResult(script_directory, "failed", f"{type(e).__name__}: {e}")
+
+# Patching every merged mod below root_directory (or the given folders), jobs folders at a time.
+# resolve_settings gets the folders and returns folder -> PatchSettings.
+def run_batch(root_directory, resolve_settings, jobs, stream=False, profile=False, dry_run=False, library_directory=None, folders=None, catalog=None):
+    merged_mod_folders = find_merged_mod_folders(root_directory, catalog) if folders is None else folders
+    if not merged_mod_folders:
+        print(f"No merged mod folders found at: {root_directory}.")
+        return []
+
+    folder_settings = resolve_settings(merged_mod_folders)
+    if any(uses_detection_library(settings) for settings in folder_settings.values()):
+        write_detection_library(library_directory or root_directory, dry_run)
+
+    # Folders left without settings have invalid INIs
+    results = [FolderResult(folder, "skipped", f"invalid INI files: {', '.join(find_invalid_ini_files(folder, catalog))}") for folder in merged_mod_folders if folder not in folder_settings]
+    merged_mod_folders = [folder for folder in merged_mod_folders if folder in folder_settings]
+
+    # Folders the catalog can answer for are never handed to a worker
+    if catalog is not None:
+        results += [result for result in (catalog.folder_result(folder, folder_settings[folder]) for folder in merged_mod_folders) if result is not None]
+        known_folders = {result.folder for result in results}
+        merged_mod_folders = [folder for folder in merged_mod_folders if folder not in known_folders]
+        print(f"Catalog: {len(results)} folders known, {catalog.read_count} INI file(s) read")
+
+    print(f"{'Previewing' if dry_run else 'Patching'} {len(merged_mod_folders)} folders using {jobs} jobs")
+    diff_root = root_directory if dry_run else None
+
+    if jobs == 1:
+        for folder in merged_mod_folders:
+            results.append(patch_folder(folder, folder_settings[folder], stream, profile, dry_run, diff_root))
+    elif merged_mod_folders:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = {executor.submit(patch_folder, folder, folder_settings[folder], stream, profile, dry_run, diff_root): folder for folder in merged_mod_folders}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    results.append(future.result())
+                except Exception as e:
+                    results.append(FolderResult(futures[future], "failed", f"{type(e).__name__}: {e}"))
+
+    results.sort(key=lambda result: result.folder)
+    print_batch_summary(root_directory, results)
+    return results
+
+# Manifest ---------------------------------------------------------------------------------
+# --manifest patches many mods with their own settings in one batch run. Each CSV row (or JSON object) is
+#   folder, num_outfits, swapvar_values, toggle_key, global_detection, delay_end, delay_start[, aks]
+# e.g. Raiden,3,"4 5 6",VK_F7,global,9.75,0. Empty cells fall back to the flags, then to the saved answers,
+# aks left open everywhere is no. Every row is checked against the INIs of its folder before anything is written.
+
+MANIFEST_COLUMNS = ("folder", "num_outfits", "swapvar_values", "toggle_key", "global_detection", "delay_end", "delay_start", "aks")
+
+# One row, arguments holds the values it sets under the names of the command line arguments
+ManifestEntry = collections.namedtuple("ManifestEntry", ["row", "folder", "arguments"])
+
+YES_ANSWERS = ("y", "yes", "global")
+NO_ANSWERS = ("n", "no", "local")
+
+# Command line argument -> value of a manifest cell, raises ValueError for a bad one
+def parse_manifest_value(column, value):
+    if isinstance(value, str):
+        value = value.strip()
+        if not value:
+            return None
+    if value is None:
+        return None
+
+    if column == "num_outfits":
+        return int(value)
+    if column == "swapvar_values":
+        values = value if isinstance(value, list) else value.replace(",", " ").split()
+        return [int(swapvar_value) for swapvar_value in values]
+    if column in ("delay_end", "delay_start"):
+        return float(value)
+    if column in ("global_detection", "aks", "idle_guard", "shared_detection"):
+        answer = str(value).strip().lower()
+        if answer in YES_ANSWERS:
+            return "y"
+        if answer in NO_ANSWERS:
+            return "n"
+        raise ValueError(f"expected y/n, got {value!r}")
+    return str(value)
+
+# (entries, errors) with errors as (row, message), CSV unless the file ends with .json
+def load_manifest(manifest_path):
+    if manifest_path.lower().endswith(".json"):
+        with open(manifest_path, "r", encoding="utf-8") as manifest_file:
+            rows = json.load(manifest_file)
+        if not isinstance(rows, list):
+            return [], [(0, f"{manifest_path}: expected a list of objects")]
+        rows = [(i + 1, row) for i, row in enumerate(rows)]
+    else:
+        with open(manifest_path, "r", encoding="utf-8-sig", newline="") as manifest_file:
+            rows = []
+            for i, cells in enumerate(csv.reader(manifest_file)):
+                # Blank lines, comments and a header row are skipped
+                if not any(cell.strip() for cell in cells) or cells[0].lstrip().startswith("#") or cells[0].strip() == "folder":
+                    continue
+                if len(cells) > len(MANIFEST_COLUMNS):
+                    rows.append((i + 1, f"{len(cells)} columns, expected at most {len(MANIFEST_COLUMNS)}"))
+                    continue
+                rows.append((i + 1, dict(zip(MANIFEST_COLUMNS, cells))))
+
+    entries = []
+    errors = []
+    for row_number, row in rows:
+        if not isinstance(row, dict):
+            errors.append((row_number, f"{row if isinstance(row, str) else 'expected an object'}"))
+            continue
+        unknown_columns = sorted(set(row) - set(MANIFEST_COLUMNS))
+        if unknown_columns:
+            errors.append((row_number, f"unknown column(s) {', '.join(unknown_columns)}"))
+            continue
+
+        arguments = {}
+        for column in MANIFEST_COLUMNS[1:]:
+            try:
+                arguments[column] = parse_manifest_value(column, row.get(column))
+            except (TypeError, ValueError) as e:
+                # Left open so the checks of the other cells still run and every problem is listed
+                arguments[column] = None
+                errors.append((row_number, f"bad {column}: {e}"))
+        folder = str(row.get("folder") or "").strip()
+        if not folder:
+            errors.append((row_number, "no folder"))
+        entries.append(ManifestEntry(row_number, folder, arguments))
+    return entries, errors
+
+# The $swapvar values [KeySwap] cycles through, None if it doesn't list plain numbers
+def keyswap_swapvar_values(keyswap):
+    try:
+        return {int(value) for value in keyswap.value_swap.split(",") if value.strip()}
+    except ValueError:
+        return None
+
+# The arguments of one manifest row: the row over the flags over the saved answers of its folder
+def manifest_folder_args(folder, arguments, args):
+    folder_args = argparse.Namespace(**vars(args))
+    for argument, value in arguments.items():
+        if value is not None:
+            setattr(folder_args, argument, value)
+
+    cached_settings = load_cached_answers(folder, find_ini_files(folder))
+    if cached_settings is not None:
+        folder_args = apply_cached_answers(folder_args, cached_settings)
+
+    # The aks column is optional, so leaving it out means no
+    if folder_args.aks is None:
+        folder_args.aks = "n"
+    if folder_args.num_outfits is None and folder_args.swapvar_values is not None:
+        folder_args.num_outfits = len(folder_args.swapvar_values)
+    return folder_args
+
+def find_open_arguments(folder_args):
+    return [argument for argument in PROMPTED_ARGUMENTS if getattr(folder_args, argument) is None]
+
+# (folder -> arguments, errors as (row, message)). Folders are paths below root_directory or the name of a merged mod folder below it.
+# Without a terminal to ask on, a row leaving settings open is an error too.
+def validate_manifest(entries, root_directory, args=None):
+    merged_mod_folders = None
+    manifest_folders = {}
+    errors = []
+
+    for entry in entries:
+        if not entry.folder:
+            continue
+        folder = os.path.normpath(os.path.join(root_directory, entry.folder))
+        if not os.path.isdir(folder):
+            if merged_mod_folders is None:
+                merged_mod_folders = find_merged_mod_folders(root_directory)
+            matches = [merged_mod_folder for merged_mod_folder in merged_mod_folders if os.path.basename(merged_mod_folder) == entry.folder]
+            if len(matches) != 1:
+                errors.append((entry.row, f"{'no' if not matches else 'more than one'} mod folder named {entry.folder} below {root_directory}"))
+                continue
+            folder = matches[0]
+
+        if folder in manifest_folders:
+            errors.append((entry.row, f"{entry.folder} is already listed"))
+            continue
+
+        ini_files = find_ini_files(folder)
+        invalid_ini_files = [filename for filename in ini_files if not is_merged_ini(os.path.join(folder, filename))]
+        if not ini_files or invalid_ini_files:
+            errors.append((entry.row, f"{entry.folder} has no INI generated by genshin_merge_mods.py{': ' + ', '.join(invalid_ini_files) if invalid_ini_files else ''}"))
+            continue
+
+        num_outfits = entry.arguments["num_outfits"]
+        swapvar_values = entry.arguments["swapvar_values"]
+        if num_outfits is not None and num_outfits < 1:
+            errors.append((entry.row, "num_outfits has to be at least 1"))
+            continue
+        if num_outfits is not None and swapvar_values is not None and len(swapvar_values) != num_outfits:
+            errors.append((entry.row, f"{num_outfits} outfits but {len(swapvar_values)} swapvar values"))
+            continue
+
+        # Every outfit has to be a variant the mod can switch to
+        if swapvar_values is not None:
+            keyswap_index = build_keyswap_index(ini_files, folder)
+            for filename in ini_files:
+                known_values = keyswap_swapvar_values(keyswap_index.get(filename, EMPTY_KEYSWAP))
+                unknown_values = [value for value in swapvar_values if known_values is not None and value not in known_values]
+                if unknown_values:
+                    errors.append((entry.row, f"{filename} has no variant with {SWAPVAR_VARIABLE} = {', '.join(map(str, unknown_values))}"))
+
+        if args is not None and not sys.stdin.isatty():
+            open_arguments = find_open_arguments(manifest_folder_args(folder, entry.arguments, args))
+            if open_arguments:
+                errors.append((entry.row, f"no {', '.join(open_arguments)} in the row, the flags or the saved answers, and no terminal to ask"))
+
+        manifest_folders[folder] = entry.arguments
+
+    return manifest_folders, errors
+
+# folder -> PatchSettings, the manifest row over the flags over the saved answers.
+# Only the settings still open after that are asked, once for all the rows that leave them open.
+# The $swapvar values are asked again for a row with another number of outfits.
+def resolve_manifest_settings(manifest_folders, args):
+    folder_settings = {}
+    shared_answers = {}
+    for folder, arguments in manifest_folders.items():
+        folder_args = manifest_folder_args(folder, arguments, args)
+        open_arguments = find_open_arguments(folder_args)
+        if open_arguments:
+            if not shared_answers:
+                print("Some manifest rows leave settings open, these answers are used for them:")
+            for argument in open_arguments:
+                value = shared_answers.get(argument)
+                if argument == "swapvar_values" and value is not None and folder_args.num_outfits is not None and len(value) != folder_args.num_outfits:
+                    value = None
+                setattr(folder_args, argument, value)
+
+        folder_settings[folder] = get_patch_settings(folder_args)
+        for field, argument in SETTINGS_ARGUMENTS:
+            if argument in open_arguments:
+                shared_answers[argument] = getattr(folder_settings[folder], field)
+    return folder_settings
+
+# Loading, checking and applying a manifest, nothing is patched unless every row is valid
+def run_manifest(manifest_path, root_directory, args, catalog=None):
+    try:
+        entries, errors = load_manifest(manifest_path)
+    except (OSError, ValueError, csv.Error) as e:
+        print(f"Can't read manifest {manifest_path}: {e}")
+        return None
+
+    manifest_folders, folder_errors = validate_manifest(entries, root_directory, args)
+    errors.extend(folder_errors)
+    if errors:
+        print(f"{manifest_path} has {len(errors)} problem(s), nothing was patched:")
+        for row, error in sorted(errors):
+            print(f"  row {row}: {error}" if row else f"  {error}")
+        return None
+    if not manifest_folders:
+        print(f"{manifest_path} lists no mods.")
+        return None
+
+    library_directory = os.path.abspath(args.library) if args.library else None
+    return run_batch(root_directory, lambda folders: resolve_manifest_settings(manifest_folders, args), max(1, args.jobs), args.stream, args.profile is not None, args.dry_run, library_directory, folders=list(manifest_folders), catalog=catalog)
+
+# Server mode ------------------------------------------------------------------------------
+# --serve keeps the script running on a Unix socket so a mod manager doesn't start a new process for every mod.
+# Each line sent is one JSON request and gets one JSON line back, requests are handled one at a time:
+#   {"command": "patch", "folder": "Raiden", "settings": {"num_outfits": 2, "swapvar_values": [1, 2], "toggle_key": "VK_F7", ...}}
+#   {"command": "dry-run", ...} like patch, {"command": "revert", "folder": "Raiden"}, {"command": "status"[, "folder": "Raiden"]}
+# The answer is {"ok": true, ...} or {"ok": false, "error": "..."}. Settings use the command line argument names and
+# the ones left out come from the answers saved for the mod. The catalog and the rendered lines stay in memory.
+
+SERVER_SOCKET_FILENAME = "autoUnderwaterOutfit.sock"
+SERVER_SETTINGS = MANIFEST_COLUMNS[1:] + ("idle_guard", "shared_detection", "dispatch")
+
+class ModServer:
+    def __init__(self, catalog, root_directory=None, library_directory=None):
+        self.catalog = catalog
+        self.root_directory = root_directory
+        self.library_directory = library_directory
+        self.started = time.monotonic()
+        self.request_count = 0
+        self.commands = {
+            "patch": lambda request: self.patch(request, dry_run=False),
+            "dry-run": lambda request: self.patch(request, dry_run=True),
+            "revert": self.revert,
+            "status": self.status,
+        }
+
+    # One line of the protocol, any error ends up in the answer instead of stopping the server
+    def handle_line(self, line):
+        self.request_count += 1
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError("a request has to be a JSON object")
+            command = self.commands.get(request.get("command"))
+            if command is None:
+                raise ValueError(f"unknown command {request.get('command')!r}, expected one of {', '.join(self.commands)}")
+
+            # Every request sees the INIs as they are now, the catalog only saves reading the unchanged ones
+            self.catalog.start_over()
+            return dict(ok=True, **command(request))
+        except (ValueError, TypeError, OSError) as e:
+            return {"ok": False, "error": str(e)}
+        except Exception as e:
+            return {"ok": False, "error": f"{type(e).__name__}: {e}"}
+
+    # The mod folder of a request, relative paths are below --root. Anything outside --root is refused
+    # (symbolic links and .. resolved), without --root only the folder of the script is served.
+    def request_folder(self, request):
+        folder = request.get("folder")
+        if not isinstance(folder, str) or not folder:
+            raise ValueError("no folder given")
+        served_directory = os.path.realpath(self.root_directory or os.path.dirname(os.path.abspath(__file__)))
+        folder = os.path.realpath(os.path.join(served_directory, folder))
+        if folder != served_directory and (self.root_directory is None or os.path.commonpath([served_directory, folder]) != served_directory):
+            raise ValueError(f"folder outside of {served_directory}: {request['folder']}")
+        if not os.path.isdir(folder):
+            raise ValueError(f"mod folder not found: {folder}")
+        return folder
+
+    # PatchSettings from the request over the answers saved for the mod, nothing is ever asked
+    def request_settings(self, request, folder):
+        arguments = request.get("settings") or {}
+        if not isinstance(arguments, dict):
+            raise ValueError("settings has to be a JSON object")
+        unknown_settings = sorted(set(arguments) - set(SERVER_SETTINGS))
+        if unknown_settings:
+            raise ValueError(f"unknown setting(s) {', '.join(unknown_settings)}")
+
+        args = argparse.Namespace(**dict.fromkeys(SERVER_SETTINGS))
+        for argument, value in arguments.items():
+            try:
+                setattr(args, argument, parse_manifest_value(argument, value))
+            except (TypeError, ValueError) as e:
+                raise ValueError(f"bad {argument}: {e}")
+        if args.dispatch not in (None, "auto", "linear"):
+            raise ValueError(f"bad dispatch: expected auto or linear, got {args.dispatch!r}")
+
+        cached_settings = load_cached_answers(folder, find_ini_files(folder), self.catalog)
+        if cached_settings is not None:
+            args = apply_cached_answers(args, cached_settings)
+        missing_settings = [argument for argument in PROMPTED_ARGUMENTS if getattr(args, argument) is None]
+        if missing_settings:
+            raise ValueError(f"missing setting(s) {', '.join(missing_settings)}, there are no saved answers for this mod")
+        if args.num_outfits < 1 or len(args.swapvar_values) != args.num_outfits:
+            raise ValueError(f"{args.num_outfits} outfits but {len(args.swapvar_values)} swapvar values")
+        return get_patch_settings(args)
+
+    def patch(self, request, dry_run):
+        folder = self.request_folder(request)
+        settings = self.request_settings(request, folder)
+
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            if uses_detection_library(settings):
+                write_detection_library(self.library_directory or self.root_directory or os.path.dirname(folder), dry_run)
+            result = self.catalog.folder_result(folder, settings) or check_and_patch_folder(folder, settings, False, dry_run)
+
+        response = {"folder": folder, "status": result.status, "detail": result.detail, "settings": settings._asdict(), "messages": output.getvalue().splitlines()}
+        if dry_run:
+            response["diffs"] = dict(result.diffs or [])
+        return response
+
+    def revert(self, request):
+        folder = self.request_folder(request)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            reverted_files = revert_ini_files(folder, find_ini_files(folder), all_layers=True)
+        return {"folder": folder, "reverted": reverted_files, "messages": output.getvalue().splitlines()}
+
+    # What the catalog knows about the INIs of a folder, or about the server itself without one
+    def status(self, request):
+        if request.get("folder") is None:
+            return {
+                "uptime": round(time.monotonic() - self.started, 3),
+                "requests": self.request_count,
+                "catalog_entries": len(self.catalog.entries),
+                "render_cache": render_underwater_outfit_lines.cache_info()._asdict(),
+            }
+
+        folder = self.request_folder(request)
+        ini_files = {}
+        for filename in sorted(find_ini_files(folder)):
+            catalog_entry = self.catalog.lookup(os.path.join(folder, filename))
+            ini_files[filename] = {
+                "merged": catalog_entry.error is None,
+                "error": catalog_entry.error,
+                "sections": len(catalog_entry.sections),
+                "sha256": catalog_entry.sha256,
+                "patched_settings": None if catalog_entry.patched_settings is None else catalog_entry.patched_settings._asdict(),
+            }
+        return {"folder": folder, "saved_answers": has_cached_answers(folder), "ini_files": ini_files}
+
+# Answering requests on socket_path until interrupted. The catalog of --root is used if there is one,
+# otherwise the catalog only lives in memory.
+def serve_mods(socket_path, root_directory=None, library_directory=None, use_catalog=True):
+    if not hasattr(socket, "AF_UNIX"):
+        print("--serve needs Unix sockets, which this platform doesn't have.")
+        return
 
-        if args.delay_start is None:
-            delay_in_seconds_start = 0.00
-        else:
-            delay_in_seconds_start = args.delay_start
+    # A socket left behind by a server that was killed is removed, a running server is left alone
+    if os.path.exists(socket_path):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe_socket:
+            try:
+                probe_socket.connect(socket_path)
+                print(f"Another server is already running on {socket_path}")
+                return
+            except ConnectionRefusedError:
+                os.remove(socket_path)
+
+    if root_directory is not None and use_catalog:
+        catalog_context = open_mod_catalog(root_directory)
+    else:
+        catalog_context = contextlib.nullcontext()
+
+    with catalog_context as catalog, socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server_socket:
+        mod_server = ModServer(catalog or ModCatalog(":memory:"), root_directory, library_directory)
+        server_socket.bind(socket_path)
+        server_socket.listen()
+        print(f"Serving on {socket_path}, press Ctrl+C to stop.")
+        try:
+            while True:
+                connection, _ = server_socket.accept()
+                with connection, connection.makefile("rwb") as stream:
+                    try:
+                        for line in stream:
+                            if line.strip():
+                                stream.write(json.dumps(mod_server.handle_line(line)).encode("utf-8") + b"\n")
+                                stream.flush()
+                    except OSError:
+                        # The client went away mid answer
+                        continue
+        finally:
+            os.remove(socket_path)
+
+# Watch mode -------------------------------------------------------------------------------
+# --watch polls the INIs of every folder patched before and re-patches the ones that changed
+# (e.g. merged again by genshin_merge_mods.py) with the settings recorded in the folder's undo log.
+
+# filename -> PatchSettings of the last patch of each INI in script_directory
+def load_recorded_settings(script_directory):
+    recorded_settings = {}
+    for filename, undo_layers in load_undo_log(script_directory).items():
+        if undo_layers and "settings" in undo_layers[-1]:
+            recorded_settings[filename] = settings_from_json(undo_layers[-1]["settings"])
+    return recorded_settings
+
+# Folders below root_directory patched before, the only ones --watch has settings for
+def find_watched_folders(root_directory):
+    watched_folders = []
+    for directory, subdirectories, filenames in os.walk(root_directory):
+        subdirectories[:] = sorted(subdirectory for subdirectory in subdirectories if not subdirectory.startswith("DISABLED"))
+        if UNDO_LOG_FILENAME in filenames:
+            watched_folders.append(directory)
+    return watched_folders
+
+# INI path -> (mtime, size), one directory listing per folder
+def stat_ini_files(folders):
+    ini_stats = {}
+    for folder in folders:
+        try:
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    if is_ini_filename(entry.name) and entry.is_file():
+                        entry_stat = entry.stat()
+                        ini_stats[entry.path] = (entry_stat.st_mtime_ns, entry_stat.st_size)
+        except FileNotFoundError:
+            continue
+    return ini_stats
+
+# Re-patching the changed INIs of one folder, each with the settings it was patched with last
+def repatch_changed_ini_files(script_directory, filenames, stream=False):
+    # Saved answers cover the whole mod, they no longer fit once merging changed its structure
+    cached_settings = load_cached_answers(script_directory, find_ini_files(script_directory))
+    if cached_settings is None and has_cached_answers(script_directory):
+        print(f"{time.strftime('%H:%M:%S')} {script_directory} was merged with different variants, run the script on it again.")
+        return
 
-        if args.num_outfits is None:
-            outfit_select_values = ",".join(map(str, range(num_outfits)))
+    recorded_settings = load_recorded_settings(script_directory)
+    fallback_settings = cached_settings or next(iter(recorded_settings.values()), None)
+
+    # INIs patched with the same settings go through one transaction
+    filenames_by_settings = collections.defaultdict(list)
+    for filename in filenames:
+        settings = cached_settings or recorded_settings.get(filename, fallback_settings)
+        ini_path = os.path.join(script_directory, filename)
+        if settings is None:
+            print(f"No recorded settings for {ini_path}, run the script on it once first.")
+        elif is_merged_ini(ini_path):
+            filenames_by_settings[settings].append(filename)
+
+    for settings, settings_filenames in filenames_by_settings.items():
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            written_files = patch_ini_files(script_directory, settings_filenames, settings, stream)
+        for filename in written_files:
+            print(f"{time.strftime('%H:%M:%S')} Re-patched: {os.path.join(script_directory, filename)}")
+
+# Polling every poll_interval seconds, an INI is re-patched once it stopped changing for debounce seconds
+def watch_mods(root_directory, poll_interval=2.0, debounce=2.0, stream=False, rescan_interval=60.0):
+    watched_folders = find_watched_folders(root_directory)
+    last_rescan = time.monotonic()
+    ini_stats = stat_ini_files(watched_folders)
+    # INI path -> when it was last seen changing
+    pending_changes = {}
+
+    print(f"Watching {len(ini_stats)} INI files in {len(watched_folders)} folders, press Ctrl+C to stop.")
+    while True:
+        time.sleep(poll_interval)
+        now = time.monotonic()
+
+        # New folders show up once they were patched by hand the first time
+        if now - last_rescan >= rescan_interval:
+            watched_folders = find_watched_folders(root_directory)
+            last_rescan = now
+
+        current_stats = stat_ini_files(watched_folders)
+        for ini_path, ini_stat in current_stats.items():
+            if ini_stats.get(ini_path) != ini_stat:
+                pending_changes[ini_path] = now
+        ini_stats = current_stats
+
+        settled_paths = [ini_path for ini_path, changed_at in pending_changes.items() if now - changed_at >= debounce]
+        if not settled_paths:
+            continue
+
+        filenames_by_folder = collections.defaultdict(list)
+        for ini_path in settled_paths:
+            del pending_changes[ini_path]
+            if ini_path in ini_stats:
+                filenames_by_folder[os.path.dirname(ini_path)].append(os.path.basename(ini_path))
+
+        for folder, filenames in sorted(filenames_by_folder.items()):
+            try:
+                repatch_changed_ini_files(folder, sorted(filenames), stream)
+            except Exception as e:
+                print(f"Failed to re-patch {folder}: {type(e).__name__}: {e}")
+
+        # Our own writes are not changes to react to
+        ini_stats.update(stat_ini_files(filenames_by_folder))
+
+# Undoing every recorded change in script_directory, or in each folder below root_directory with an undo log
+def revert_all(script_directory=None, root_directory=None):
+    if root_directory is None:
+        folders = [script_directory]
+    else:
+        folders = sorted(folder for folder, _, filenames in os.walk(root_directory) if UNDO_LOG_FILENAME in filenames)
+
+    reverted_count = 0
+    for folder in folders:
+        reverted_count += len(revert_ini_files(folder, find_ini_files(folder), all_layers=True))
+
+    # Nothing below root reads the shared detection INI anymore, unless an INI couldn't be reverted
+    if root_directory is not None and not find_watched_folders(root_directory):
+        library_path = os.path.join(root_directory, DETECTION_LIBRARY_FILENAME)
+        if os.path.isfile(library_path):
+            os.remove(library_path)
+            print(f"Removed the shared detection INI: {library_path}")
+
+    if not reverted_count:
+        print("Nothing to revert.")
+
+def print_batch_summary(root_directory, results):
+    for result in results:
+        print(f"{result.status.upper():<8} {os.path.relpath(result.folder, root_directory)} - {result.detail}")
+
+    counts = collections.Counter(result.status for result in results)
+    print(f"Patched: {counts['patched']}, Unchanged: {counts['unchanged']}, Skipped: {counts['skipped']}, Failed: {counts['failed']}")
+
+# Load cost --------------------------------------------------------------------------------
+# --load-cost estimates what the INIs of every mod below --root (or of this mod) cost 3DMigoto, which parses them all
+# at game start and on every reload: sections, lines, statements run from [Present] every frame and sections
+# overriding a hash that another loaded section overrides too. Each mod is shown before and after patching
+# and the mods adding the most are flagged.
+
+# hashes counts the sections overriding each hash
+LoadCost = collections.namedtuple("LoadCost", ["sections", "lines", "present_statements", "hashes"])
+
+def measure_load_cost(lines):
+    _, sections = index_sections(lines)
+    statements = collections.defaultdict(list)
+    hashes = collections.Counter()
+    for section_name, section_spans in sections.items():
+        for section_span in section_spans:
+            for line in lines[section_span.start_line + 1:section_span.end_line]:
+                statement = line.strip()
+                if not statement or statement.startswith(";"):
+                    continue
+                statements[section_name].append(statement)
+                key, _, value = statement.partition("=")
+                if key.strip().lower() == "hash":
+                    hashes[value.strip().lower()] += 1
+
+    # [Present] and every command list it runs, each counted once
+    present_statements = 0
+    pending_sections = [PRESENT_SECTION]
+    seen_sections = set()
+    while pending_sections:
+        section_name = pending_sections.pop()
+        if section_name in seen_sections:
+            continue
+        seen_sections.add(section_name)
+        for statement in statements.get(section_name, []):
+            present_statements += 1
+            key, _, value = statement.partition("=")
+            if key.strip().lower() == "run":
+                pending_sections.append(value.strip())
+
+    return LoadCost(sum(len(section_spans) for section_spans in sections.values()), len(lines), present_statements, hashes)
+
+def add_load_costs(load_costs):
+    hashes = collections.Counter()
+    for load_cost in load_costs:
+        hashes.update(load_cost.hashes)
+    return LoadCost(sum(load_cost.sections for load_cost in load_costs), sum(load_cost.lines for load_cost in load_costs),
+                    sum(load_cost.present_statements for load_cost in load_costs), hashes)
+
+# Sections of load_cost overriding a hash that is overridden more than once in library_hashes
+def count_duplicate_hashes(load_cost, library_hashes):
+    return sum(count for hash_value, count in load_cost.hashes.items() if library_hashes[hash_value] > 1)
+
+def measure_ini_bytes(ini_bytes):
+    return measure_load_cost(split_lines(decode_ini_bytes(ini_bytes)))
+
+# (before, after) LoadCost of the INIs of one mod, None for a side that can't be told. A patched INI is taken
+# back to its original in memory with the undo log, an unpatched one is patched in memory with settings.
+def measure_mod_load_cost(script_directory, settings):
+    undo_log = load_undo_log(script_directory)
+    before_costs = []
+    after_costs = []
+    for filename in sorted(find_ini_files(script_directory)):
+        ini_path = os.path.join(script_directory, filename)
+        with open(ini_path, "rb") as ini_file:
+            ini_bytes = ini_file.read()
+
+        undo_layers = undo_log.get(filename, [])
+        if undo_layers and hashlib.sha256(ini_bytes).hexdigest() == undo_layers[-1]["patched_sha256"]:
+            original_bytes = ini_bytes
+            with contextlib.redirect_stdout(io.StringIO()):
+                for undo_layer in reversed(undo_layers):
+                    original_bytes = revert_undo_layer(ini_path, original_bytes, undo_layer)
+                    if original_bytes is None:
+                        break
+            before_costs.append(None if original_bytes is None else measure_ini_bytes(original_bytes))
+            after_costs.append(measure_ini_bytes(ini_bytes))
+        elif f"[{KEYSWAP_ALT_SECTION}]".encode() in ini_bytes:
+            # Patched without an undo log to go back with
+            before_costs.append(None)
+            after_costs.append(measure_ini_bytes(ini_bytes))
         else:
-            outfit_select_values = ",".join(map(str, range(args.num_outfits)))
+            patch_result = None if settings is None else patch_ini_text(ini_bytes, settings)
+            before_costs.append(measure_ini_bytes(ini_bytes))
+            after_costs.append(None if patch_result is None or patch_result.error else measure_ini_bytes(patch_result.text))
+
+    before = None if None in before_costs else add_load_costs(before_costs)
+    after = None if None in after_costs else add_load_costs(after_costs)
+    return before, after
+
+# The settings a mod would be patched with, None if some answer is neither saved nor given as a flag
+def find_load_cost_settings(script_directory, args):
+    cached_settings = load_cached_answers(script_directory, find_ini_files(script_directory))
+    if cached_settings is not None:
+        args = apply_cached_answers(args, cached_settings)
+    if any(getattr(args, argument) is None for argument in PROMPTED_ARGUMENTS):
+        return None
+    return get_patch_settings(args)
+
+def format_load_cost_change(before, after):
+    if before is None or after is None:
+        return f"{'?' if before is None else before:>6} -> {'?' if after is None else after:<6}"
+    return f"{before:>6} -> {after:<6}{'' if after == before else f' ({after - before:+})':<9}"
+
+# Measuring every mod in folders, and the shared detection INI if it is there or patching would write it
+def run_load_cost(root_directory, folders, args, library_directory, top=5):
+    if not folders:
+        print(f"No merged mod folders found at: {root_directory}.")
+        return
 
-        if args.aks is None:
-            adjust_key_swap = get_user_yes_or_no_input("Do you want the Underwater Outfits to only be available when you are underwater or if functionality is toggled off? (yes/no):\n").strip().lower()
+    mod_load_costs = []
+    uses_library = False
+    for folder in folders:
+        try:
+            settings = find_load_cost_settings(folder, args)
+            uses_library = uses_library or (settings is not None and uses_detection_library(settings))
+            mod_load_costs.append((folder, *measure_mod_load_cost(folder, settings)))
+        except (OSError, ValueError) as e:
+            print(f"Can't measure {folder}: {e}")
+
+    library_path = os.path.join(library_directory, DETECTION_LIBRARY_FILENAME)
+    library_cost = None
+    if os.path.isfile(library_path):
+        with open(library_path, "rb") as library_file:
+            library_cost = measure_ini_bytes(library_file.read())
+    elif uses_library:
+        library_cost = measure_load_cost([line + "\n" for line in DETECTION_LIBRARY_LINES])
+    print_load_cost_report(root_directory, mod_load_costs, None if library_cost is None else (library_path, library_cost), top)
+
+# The table of every mod and the library, the top mods adding the most lines are marked with *
+def print_load_cost_report(root_directory, mod_load_costs, library=None, top=5):
+    # A side that can't be told counts as the other one in the totals
+    before_total = add_load_costs([before or after for _, before, after in mod_load_costs if before or after])
+    after_total = add_load_costs([after or before for _, before, after in mod_load_costs if before or after])
+
+    rows = [(os.path.relpath(folder, root_directory), folder, before, after) for folder, before, after in mod_load_costs]
+    if library is not None:
+        library_path, library_cost = library
+        after_total = add_load_costs([after_total, library_cost])
+        rows.append((os.path.relpath(library_path, root_directory), library_path, LoadCost(0, 0, 0, collections.Counter()), library_cost))
+    rows.append(("Library total", None, before_total, after_total))
+
+    added_lines = {folder: after.lines - before.lines for folder, before, after in mod_load_costs if before and after and after.lines > before.lines}
+    top_folders = sorted(added_lines, key=added_lines.get, reverse=True)[:top]
+
+    name_width = max(len(name) for name, _, _, _ in rows)
+    print(f"  {'Mod':<{name_width}} {'Sections':<24} {'Lines':<24} {'[Present] statements':<24} {'Duplicate hashes'}")
+    for name, folder, before, after in rows:
+        columns = [format_load_cost_change(before and getattr(before, field), after and getattr(after, field)) for field in ("sections", "lines", "present_statements")]
+        columns.append(format_load_cost_change(before and count_duplicate_hashes(before, before_total.hashes), after and count_duplicate_hashes(after, after_total.hashes)))
+        print(f"{'*' if folder in top_folders else ' '} {name:<{name_width}} {' '.join(f'{column:<24}' for column in columns)}".rstrip())
+
+    unknown_count = sum(1 for _, before, after in mod_load_costs if before is None or after is None)
+    if unknown_count:
+        print(f"{unknown_count} mod(s) show ? where no saved answers, flags or undo log tell that side, the totals count them as unchanged.")
+    if top_folders:
+        print("Adding the most to every reload:")
+        load_costs = {folder: (before, after) for folder, before, after in mod_load_costs}
+        for folder in top_folders:
+            before, after = load_costs[folder]
+            print(f"  {os.path.relpath(folder, root_directory)}: +{added_lines[folder]} lines, {after.sections - before.sections:+} sections, "
+                  f"{after.present_statements - before.present_statements:+} [Present] statements per frame")
+
+# Simulator --------------------------------------------------------------------------------
+# --simulate replays frames on dry land and in water against the command logic of an INI (or the lines
+# this script would add) with a small interpreter for the part of 3DMigoto syntax used here.
+# It reports the commands run per frame and every change of $swapvar.
+
+# Sections of the non global version that are drawn while the character is in water
+DETECTION_SECTIONS = ("TextureOverrideSwimIcon", "TextureOverrideSwimDownIcon", "ShaderOverrideWaterCensorWhite")
+# Texture slot the water censor shader sees in water, see [TextureOverrideWaterCensor3]
+WATER_CENSOR_FILTER_INDEX = 102
+# Section settings that are not commands run when the section runs
+SECTION_SETTINGS = ("hash", "match_priority", "match_first_index", "match_index_count", "filter_index", "allow_duplicate_hash", "condition", "key", "back", "type", "format", "stride", "filename")
+
+SimulatedFrame = collections.namedtuple("SimulatedFrame", ["frame", "time", "submerged", "ops", "swapvar"])
+
+EXPRESSION_TOKEN = re.compile(r"\s*(?:(\d+\.?\d*|\.\d+)|(\$\\[\w\\]+|\$\w+)|([A-Za-z_]\w*(?:-[A-Za-z_]\w*)?)|(\|\||&&|==|!=|<=|>=|//|[-+*/%<>!()]))")
+
+# Binary operators from the loosest to the tightest binding
+BINARY_OPERATORS = (
+    {"||": lambda a, b: float(bool(a) or bool(b))},
+    {"&&": lambda a, b: float(bool(a) and bool(b))},
+    {"==": lambda a, b: float(a == b), "!=": lambda a, b: float(a != b)},
+    {"<": lambda a, b: float(a < b), "<=": lambda a, b: float(a <= b), ">": lambda a, b: float(a > b), ">=": lambda a, b: float(a >= b)},
+    {"+": lambda a, b: a + b, "-": lambda a, b: a - b},
+    {"*": lambda a, b: a * b, "/": lambda a, b: a / b if b else 0.0, "//": lambda a, b: a // b if b else 0.0, "%": lambda a, b: a % b if b else 0.0},
+)
+
+def tokenize_expression(expression):
+    tokens = []
+    position = 0
+    expression = expression.strip()
+    while position < len(expression):
+        match = EXPRESSION_TOKEN.match(expression, position)
+        if match is None or match.end() == position:
+            raise ValueError(f"can't parse expression: {expression}")
+        number, variable, name, operator = match.groups()
+        if number is not None:
+            tokens.append(("number", float(number)))
+        elif variable is not None:
+            tokens.append(("variable", variable))
+        elif name is not None:
+            tokens.append(("name", name))
         else:
-            adjust_key_swap = args.aks
+            tokens.append(("operator", operator))
+        position = match.end()
+    return tokens
+
+# Compiling an expression into a function of the simulator state, by recursive descent over BINARY_OPERATORS
+def compile_expression(expression):
+    tokens = tokenize_expression(expression)
+    position = 0
+
+    def peek_operator():
+        if position < len(tokens) and tokens[position][0] == "operator":
+            return tokens[position][1]
+        return None
+
+    def parse_binary(level):
+        nonlocal position
+        if level == len(BINARY_OPERATORS):
+            return parse_unary()
+        left = parse_binary(level + 1)
+        while peek_operator() in BINARY_OPERATORS[level]:
+            apply_operator = BINARY_OPERATORS[level][peek_operator()]
+            position += 1
+            right = parse_binary(level + 1)
+            left = (lambda apply_operator, left, right: lambda state: apply_operator(left(state), right(state)))(apply_operator, left, right)
+        return left
+
+    def parse_unary():
+        nonlocal position
+        operator = peek_operator()
+        if operator == "-":
+            position += 1
+            operand = parse_unary()
+            return lambda state: -operand(state)
+        if operator == "!":
+            position += 1
+            operand = parse_unary()
+            return lambda state: float(not operand(state))
+        return parse_primary()
+
+    def parse_primary():
+        nonlocal position
+        if position >= len(tokens):
+            raise ValueError(f"expression ends early: {expression}")
+        kind, value = tokens[position]
+        position += 1
+        if kind == "number":
+            return lambda state: value
+        if kind == "variable":
+            return lambda state: state.variables.get(value, 0.0)
+        if kind == "name":
+            if value == "time":
+                return lambda state: state.time
+            return lambda state: state.resources.get(value, 0.0)
+        if value == "(":
+            inner = parse_binary(0)
+            if peek_operator() != ")":
+                raise ValueError(f"missing ) in expression: {expression}")
+            position += 1
+            return inner
+        raise ValueError(f"unexpected {value} in expression: {expression}")
+
+    compiled = parse_binary(0)
+    if position != len(tokens):
+        raise ValueError(f"can't parse expression: {expression}")
+    return compiled
+
+# Statements are ("assign", post, variable, expression), ("run", post, section name),
+# ("if", post, [(condition, statements), ...]) with None as the condition of else, or ("command", post, text).
+# Value lists like "$swapvar = 0,1" only cycle on key presses and count as plain commands, like empty values.
+def compile_commands(lines, section_name):
+    root = []
+    # Open if blocks as (branches, statements of the current branch)
+    open_blocks = []
+    statements = root
+
+    for line in lines:
+        post = False
+        if line.startswith("post "):
+            post, line = True, line[5:].strip()
+        elif line.startswith("pre "):
+            line = line[4:].strip()
+
+        keyword = line.split(None, 1)[0]
+        if keyword == "if":
+            branches = [(compile_expression(line[2:]), [])]
+            statements.append(("if", post, branches))
+            open_blocks.append((branches, statements))
+            statements = branches[-1][1]
+        elif keyword in ("elif", "else"):
+            if not open_blocks:
+                raise ValueError(f"[{section_name}] {keyword} without if")
+            branches = open_blocks[-1][0]
+            if keyword == "elif" or line.startswith("else if"):
+                condition = compile_expression(line[4:] if keyword == "elif" else line[7:])
+            else:
+                condition = None
+            branches.append((condition, []))
+            statements = branches[-1][1]
+        elif keyword == "endif":
+            if not open_blocks:
+                raise ValueError(f"[{section_name}] endif without if")
+            statements = open_blocks.pop()[1]
+        elif "=" in line:
+            target, expression = (part.strip() for part in line.split("=", 1))
+            if target == "run":
+                statements.append(("run", post, expression))
+            elif target.startswith("$") and expression and "," not in expression:
+                statements.append(("assign", post, target, compile_expression(expression)))
+            elif target not in SECTION_SETTINGS:
+                statements.append(("command", post, line))
+        else:
+            statements.append(("command", post, line))
+
+    if open_blocks:
+        raise ValueError(f"[{section_name}] if without endif")
+    return root
+
+class SimulatorState:
+    def __init__(self):
+        self.variables = {}
+        self.resources = {}
+        self.time = 0.0
+        self.ops = 0
+
+# The command logic of one INI
+class SimulatedIni:
+    def __init__(self, lines):
+        section_lines = collections.defaultdict(list)
+        section_name = None
+        for line in lines:
+            header = parse_section_header(line)
+            if header is not None:
+                section_name = header
+                continue
+            line = line.strip()
+            if section_name is not None and line and not line.startswith(";"):
+                section_lines[section_name].append(line)
+
+        self.constants = section_lines.get(CONSTANTS_SECTION, [])
+        # Sections with the same name run one after the other
+        self.sections = {name: compile_commands(lines, name) for name, lines in section_lines.items() if name != CONSTANTS_SECTION}
+
+    def initial_state(self):
+        state = SimulatorState()
+        for line in self.constants:
+            declaration = line.split("=", 1)
+            words = declaration[0].split()
+            if words and words[0] == "global" and words[-1].startswith("$"):
+                state.variables[words[-1]] = compile_expression(declaration[1])(state) if len(declaration) == 2 else 0.0
+        return state
+
+    def run_section(self, state, section_name, post=False):
+        self.run_statements(state, self.sections.get(section_name, ()), post)
+
+    def run_statements(self, state, statements, post):
+        for statement in statements:
+            kind, statement_post = statement[0], statement[1]
+            if kind == "if":
+                # A block runs in the phase its first command belongs to, like 3DMigoto's pre/post split
+                if statement_post != post:
+                    continue
+                for condition, branch in statement[2]:
+                    if condition is not None:
+                        state.ops += 1
+                    if condition is None or condition(state):
+                        self.run_statements(state, branch, post)
+                        break
+                continue
+
+            if statement_post != post:
+                continue
+            state.ops += 1
+            if kind == "assign":
+                state.variables[statement[2]] = statement[3](state)
+            elif kind == "run":
+                self.run_section(state, statement[2], post)
+
+# [(submerged, frame count)] from e.g. "dry:2s water:15s dry:12s", counts without s are frames
+def parse_scenario(scenario, fps):
+    phases = []
+    for step in scenario.split():
+        where, _, duration = step.partition(":")
+        if where not in ("dry", "water"):
+            raise ValueError(f"unknown scenario step {step}, use dry:<duration> or water:<duration>")
+        frames = round(float(duration[:-1]) * fps) if duration.endswith("s") else int(duration)
+        phases.append((where == "water", frames))
+    return phases
+
+# Every frame: the character is drawn (and the water detection in water), then [Present] runs and its post commands
+def simulate_frames(simulated_ini, scenario, fps=60):
+    state = simulated_ini.initial_state()
+    frames = []
+    frame = 0
+
+    for submerged, frame_count in parse_scenario(scenario, fps):
+        for _ in range(frame_count):
+            frame += 1
+            state.time = frame / fps
+            state.ops = 0
+
+            state.variables["$active"] = 1.0
+            state.variables[GLOBAL_SUBMERGED_VARIABLE] = 1.0 if submerged else 0.0
+            state.variables[SHARED_SUBMERGED_VARIABLE] = 1.0 if submerged else 0.0
+            state.resources["ps-t1"] = WATER_CENSOR_FILTER_INDEX if submerged else 0.0
+            if submerged:
+                for section_name in DETECTION_SECTIONS:
+                    simulated_ini.run_section(state, section_name)
+
+            simulated_ini.run_section(state, PRESENT_SECTION)
+            simulated_ini.run_section(state, PRESENT_SECTION, post=True)
+            frames.append(SimulatedFrame(frame, state.time, submerged, state.ops, state.variables.get(SWAPVAR_VARIABLE, 0.0)))
+
+    return frames
+
+# Frame counts, ops per frame on dry land and in water, and every change of $swapvar as (frame, time, value)
+def summarize_simulation(frames):
+    report = {"frames": len(frames), "ops": sum(frame.ops for frame in frames)}
+    for name, submerged in (("dry", False), ("water", True)):
+        ops = [frame.ops for frame in frames if frame.submerged == submerged]
+        if ops:
+            report[f"{name}_ops_per_frame"] = {"min": min(ops), "mean": sum(ops) / len(ops), "max": max(ops)}
+
+    timeline = []
+    previous_swapvar = None
+    for frame in frames:
+        if frame.swapvar != previous_swapvar:
+            timeline.append((frame.frame, round(frame.time, 4), frame.swapvar))
+            previous_swapvar = frame.swapvar
+    report["swapvar_timeline"] = timeline
+    return report
+
+# The lines the patch would add on their own, inside a minimal merged INI
+def generated_simulation_lines(settings):
+    lines_to_add_constants, lines_to_add_present = render_lines_for_ini(settings, EMPTY_KEYSWAP)
+    return [
+        f"[{CONSTANTS_SECTION}]",
+        f"global persist {SWAPVAR_VARIABLE} = 0",
+        "global $active",
+        *lines_to_add_constants,
+        f"[{PRESENT_SECTION}]",
+        "post $active = 0",
+        *lines_to_add_present,
+    ]
 
-        # Create backups before making any changes
-        backup_paths = []
-        for filename in ini_files:
-            ini_path = os.path.join(script_directory, filename)
-            backup_path = create_backup(ini_path)
-            backup_paths.append(backup_path)
+def print_simulation_report(report):
+    print(f"Simulated {report['frames']} frames, {report['ops']} commands run")
+    for name in ("dry", "water"):
+        ops = report.get(f"{name}_ops_per_frame")
+        if ops is not None:
+            print(f"  {name:<6} {ops['min']} to {ops['max']} commands per frame, {ops['mean']:.2f} on average")
+    print(f"{SWAPVAR_VARIABLE} timeline:")
+    for frame, frame_time, swapvar in report["swapvar_timeline"]:
+        print(f"  frame {frame:>6} ({frame_time:8.3f} s): {SWAPVAR_VARIABLE} = {swapvar:g}")
+
+# Profiling --------------------------------------------------------------------------------
+# --profile wraps every stage below with a timer and open() with a file that counts what goes
+# through it. Nothing is wrapped unless profiling is started, so normal runs don't pay for it.
+
+PROFILER = None
+
+# Module functions and IniDocument methods timed by --profile, as (name, stage, argument holding the INI path)
+PROFILED_FUNCTIONS = (
+    ("find_ini_files", "discovery", None),
+    ("find_merged_mod_folders", "discovery", None),
+    ("check_ini_file", "validation", 0),
+    ("build_keyswap_index", "keyswap", None),
+    ("apply_underwater_outfit", "apply", "document"),
+    ("reapply_underwater_outfit", "reapply", "document"),
+    ("stream_patch_ini_file", "stream", 1),
+    ("create_backup", "backup", 0),
+    ("recover_interrupted_commit", "recovery", None),
+    ("revert_ini_files", "revert", None),
+)
+PROFILED_METHODS = (
+    "add_lines_to_section",
+    "ensure_present_section_exists",
+    "remove_swapvar_values",
+    "modify_condition_value",
+    "replace_lines",
+    "find_patched_blocks",
+    "append_text",
+)
+
+class Profiler:
+    def __init__(self):
+        self.started = time.perf_counter()
+        # stage -> [calls, seconds]
+        self.stages = {}
+        # INI path -> counters
+        self.files = {}
+
+    def file_stats(self, path):
+        path = os.path.abspath(path)
+        if path not in self.files:
+            self.files[path] = {"opens": 0, "bytes_read": 0, "bytes_written": 0, "lines_scanned": 0, "seconds": 0.0}
+        return self.files[path]
+
+    def add_stage(self, stage, seconds, path=None):
+        stage_stats = self.stages.setdefault(stage, [0, 0.0])
+        stage_stats[0] += 1
+        stage_stats[1] += seconds
+        if path is not None:
+            self.file_stats(path)["seconds"] += seconds
+
+    def report(self):
+        return {
+            "wall_seconds": time.perf_counter() - self.started,
+            "stages": {stage: {"calls": calls, "seconds": seconds} for stage, (calls, seconds) in self.stages.items()},
+            "files": self.files,
+        }
+
+    # Adding the stages and files of another report, e.g. one sent back by a batch worker
+    def merge(self, report):
+        for stage, stage_stats in report["stages"].items():
+            own_stats = self.stages.setdefault(stage, [0, 0.0])
+            own_stats[0] += stage_stats["calls"]
+            own_stats[1] += stage_stats["seconds"]
+        for path, file_stats in report["files"].items():
+            own_stats = self.file_stats(path)
+            for counter, value in file_stats.items():
+                own_stats[counter] += value
+
+# File object counting bytes and lines read and bytes written into the stats of one INI
+class ProfiledFile:
+    def __init__(self, file, stats):
+        self._file = file
+        self._stats = stats
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def __enter__(self):
+        self._file.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return self._file.__exit__(exc_type, exc_value, traceback)
+
+    # Text mode counts characters as bytes, the same for the ASCII INIs use
+    def _count_read(self, data):
+        self._stats["bytes_read"] += len(data)
+        self._stats["lines_scanned"] += data.count(b"\n" if isinstance(data, bytes) else "\n")
+        return data
+
+    def read(self, *args):
+        return self._count_read(self._file.read(*args))
+
+    def readline(self, *args):
+        return self._count_read(self._file.readline(*args))
+
+    def readlines(self, *args):
+        lines = self._file.readlines(*args)
+        for line in lines:
+            self._count_read(line)
+        return lines
+
+    def __iter__(self):
+        stats = self._stats
+        for line in self._file:
+            stats["bytes_read"] += len(line)
+            stats["lines_scanned"] += 1
+            yield line
+
+    def write(self, data):
+        self._stats["bytes_written"] += len(data)
+        return self._file.write(data)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+def profiled_open(file, *args, **kwargs):
+    opened_file = builtins.open(file, *args, **kwargs)
+    if PROFILER is None or not isinstance(file, (str, bytes, os.PathLike)):
+        return opened_file
+
+    stats = PROFILER.file_stats(os.fsdecode(file))
+    stats["opens"] += 1
+    return ProfiledFile(opened_file, stats)
+
+def profiled_stage(function, stage, path_argument):
+    @functools.wraps(function)
+    def profiled(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            if path_argument == "document":
+                path = getattr(args[0], "profile_path", None)
+            elif path_argument is not None and len(args) > path_argument:
+                path = args[path_argument]
+            else:
+                path = None
+            if PROFILER is not None:
+                PROFILER.add_stage(stage, time.perf_counter() - start, path)
+    return profiled
+
+def profiled_load(function):
+    @functools.wraps(function)
+    def profiled(cls, ini_path):
+        start = time.perf_counter()
+        ini_document = function(cls, ini_path)
+        ini_document.profile_path = ini_path
+        if PROFILER is not None:
+            PROFILER.add_stage("load", time.perf_counter() - start, ini_path)
+        return ini_document
+    return profiled
+
+# Staged files are written through tempfile, their size is counted when the transaction commits
+def profiled_commit(function):
+    @functools.wraps(function)
+    def profiled(self, undo_log):
+        if PROFILER is None:
+            return function(self, undo_log)
+
+        for filename, staged_file in self.staged_files:
+            staged_file.flush()
+            PROFILER.file_stats(os.path.join(self.script_directory, filename))["bytes_written"] += os.path.getsize(staged_file.name)
+        start = time.perf_counter()
+        try:
+            return function(self, undo_log)
+        finally:
+            PROFILER.add_stage("write-back", time.perf_counter() - start)
+    return profiled
+
+# Wrapping the stages once per process
+def install_profiling_hooks():
+    module_globals = globals()
+    if module_globals.get("open") is profiled_open:
+        return
 
-        # Adds autoUnderwaterOutfit
-        if global_detection in ["yes", "y"]:
-            add_underwater_outfit_lines_to_ini_sections_global(ini_files, script_directory, key_toggle, num_outfits, swapvar_values, outfit_select_values, key_swap, key_back, key_swap_type, value_swap, delay_in_seconds_end, delay_in_seconds_start)
-        else:
-            add_underwater_outfit_lines_to_ini_sections(ini_files, script_directory, key_toggle, num_outfits, swapvar_values, outfit_select_values, key_swap, key_back, key_swap_type, value_swap, delay_in_seconds_end, delay_in_seconds_start)
+    module_globals["open"] = profiled_open
+    for name, stage, path_argument in PROFILED_FUNCTIONS:
+        module_globals[name] = profiled_stage(module_globals[name], stage, path_argument)
+    for name in PROFILED_METHODS:
+        setattr(IniDocument, name, profiled_stage(getattr(IniDocument, name), f"IniDocument.{name}", "document"))
+    IniDocument.load = classmethod(profiled_load(IniDocument.load.__func__))
+    IniTransaction.commit = profiled_commit(IniTransaction.commit)
+
+# Starting a new profile, returns the one it replaces
+def start_profiling():
+    global PROFILER
+    install_profiling_hooks()
+    previous_profiler = PROFILER
+    PROFILER = Profiler()
+    return previous_profiler
+
+def stop_profiling(previous_profiler=None):
+    global PROFILER
+    report = PROFILER.report()
+    PROFILER = previous_profiler
+    return report
+
+def print_profile_summary(report, top_files=5):
+    print(f"\nProfile ({report['wall_seconds']:.3f} s wall time):")
+    for stage, stage_stats in sorted(report["stages"].items(), key=lambda item: item[1]["seconds"], reverse=True):
+        print(f"  {stage:<40} {stage_stats['calls']:>6} calls {stage_stats['seconds'] * 1000:>10.1f} ms")
+
+    slowest_files = sorted(report["files"].items(), key=lambda item: item[1]["seconds"], reverse=True)[:top_files]
+    if slowest_files:
+        print("Slowest files:")
+        for path, file_stats in slowest_files:
+            print(f"  {path}: {file_stats['seconds'] * 1000:.1f} ms, {file_stats['opens']} opens, {file_stats['bytes_read']} bytes read, {file_stats['bytes_written']} bytes written, {file_stats['lines_scanned']} lines scanned")
+
+# Writing the JSON report of the run, with the profile of every folder of a batch run
+def write_profile_report(report_path, batch_results=None):
+    if batch_results:
+        folders = {}
+        for result in batch_results:
+            if result.profile is not None:
+                PROFILER.merge(result.profile)
+                folders[result.folder] = result.profile
+        report = stop_profiling()
+        report["folders"] = folders
+    else:
+        report = stop_profiling()
+
+    with builtins.open(report_path, "w", encoding="utf-8") as report_file:
+        json.dump(report, report_file, indent=2)
+
+    print_profile_summary(report)
+    print(f"Profile written to {report_path}")
 
-        # Removing $swapvar variables if only available underwater
-        if adjust_key_swap in ["yes", "y"]:
-            for filename in ini_files:
-                ini_path = os.path.join(script_directory, filename)
-                remove_swapvar_values(ini_path, swapvar_values)
+def main():
+    parser = argparse.ArgumentParser(description="Add autoUnderwaterOutfit Lines to your ini file.")
+    parser.add_argument("--num_outfits", type=int, help="Number of Underwater Outfits.")
+    parser.add_argument("--swapvar_values", nargs='+', type=int, help=f"Values of {SWAPVAR_VARIABLE} for each Underwater Outfit.")
+    parser.add_argument("--toggle_key", type=str, help="Key for toggling auto underwater outfit on/off.")
+    parser.add_argument("--global_detection", type=str, choices=["y", "n"], help="Are you using RemoveUnderwaterCensorship global version? (yes/no)")
+    parser.add_argument("--delay_end", type=float, help="Set the delayAmount in seconds for switching the outfit after leaving water.")
+    parser.add_argument("--delay_start", type=float, help="Set the delayAmount in seconds for switching the outfit when entering water.")
+    parser.add_argument("--aks", type=str, choices=["y", "n"], help="Do you want the Underwater Outfits to only be available when you are underwater or if functionality is toggled off.")
+    parser.add_argument("--idle_guard", type=str, choices=["y", "n"], help="Wrap the per-frame [Present] logic in one check so frames on dry land with nothing pending skip it (default: n).")
+    parser.add_argument("--shared_detection", type=str, choices=["y", "n"], help=f"Detect water once in a shared {DETECTION_LIBRARY_FILENAME} instead of in every patched INI (default: n).")
+    parser.add_argument("--dispatch", type=str, choices=["auto", "linear"], help=f"How $swapvar is picked for the selected Underwater Outfit: the layout with the fewest comparisons per frame or always the if/elif chain (default: {DEFAULT_DISPATCH}).")
+    parser.add_argument("--library", type=str, help=f"Folder for {DETECTION_LIBRARY_FILENAME} (default: --root, or the folder above this mod).")
+    parser.add_argument("--root", type=str, help="Mods folder to patch every merged mod below it in one batch run.")
+    parser.add_argument("--manifest", type=str, help="CSV or JSON file with the settings of many mods (folder,num_outfits,swapvar_values,toggle_key,global_detection,delay_end,delay_start[,aks]), checked up front and patched in one batch run. Folders are relative to --root, or to the manifest.")
+    parser.add_argument("--stream", action="store_true", help="Patch each INI line by line into a temp file instead of loading it into memory (for very large INIs).")
+    parser.add_argument("--no-catalog", action="store_true", help=f"Don't use or update {CATALOG_FILENAME}, the record of every INI below --root that lets later runs skip unchanged folders.")
+    parser.add_argument("--serve", nargs="?", const="", help=f"Keep running and answer JSON requests (patch, dry-run, revert, status) on a Unix socket, at the given path or {SERVER_SOCKET_FILENAME} in --root or the script folder.")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="Number of folders patched in parallel with --root (default: number of CPU cores).")
+    parser.add_argument("--revert", action="store_true", help="Undo every change this script recorded, in this folder or in every mod below --root.")
+    parser.add_argument("--watch", action="store_true", help="Keep running and re-patch INIs below --root whenever they are merged again, with the settings they were patched with.")
+    parser.add_argument("--poll-interval", type=float, default=2.0, help="Seconds between checks for changed INIs with --watch.")
+    parser.add_argument("--debounce", type=float, default=2.0, help="Seconds an INI has to stay unchanged before --watch re-patches it.")
+    parser.add_argument("--load-cost", action="store_true", help="Estimate what the INIs of every mod below --root (or of this mod) cost 3DMigoto on each load, before and after patching, without writing anything.")
+    parser.add_argument("--top", type=int, default=5, help="Number of mods adding the most that --load-cost flags.")
+    parser.add_argument("--simulate", nargs="?", const="", help="Replay frames on dry land and in water against the lines this script would add, or against the given patched INI, and show the commands run per frame and the $swapvar timeline.")
+    parser.add_argument("--scenario", type=str, default="dry:2s water:15s dry:12s", help="Frames for --simulate, e.g. 'dry:2s water:15s dry:120' (durations in seconds with s, frames without).")
+    parser.add_argument("--fps", type=int, default=60, help="Frames per second for --simulate.")
+    parser.add_argument("--dry-run", action="store_true", help="Only show what would change as a unified diff, no file is written.")
+    parser.add_argument("--diff-output", type=str, help="Save the --dry-run diff to this file instead of printing it.")
+    parser.add_argument("--profile", nargs="?", const=PROFILE_REPORT_FILENAME, help=f"Time every stage and count file access per INI, the JSON report goes to the given path (default: {PROFILE_REPORT_FILENAME}).")
 
-        # Signing and adding the new condition value for [KeySwap]
-        line_to_add = "; .ini modified by autoUnderwaterOutfit.py - Created by a4happy20 - https://github.com/a4happy20/autoUnderwaterOutfit"
-        for filename in ini_files:
-            ini_path = os.path.join(script_directory, filename)
-            add_line_to_ini(ini_path, line_to_add)
-            modify_condition_value(ini_path, CONDITION)
+    args = parser.parse_args()
 
-        print(f"Successfully added {num_outfits} Underwater Outfits")
+    if args.profile is not None:
+        start_profiling()
 
-        # Offer the option to revert changes and restore backups
-        revert_changes = input("Do you want to revert changes and restore backups? (yes/no):\n").strip().lower()
+    batch_results = None
+    try:
+        if args.simulate is not None:
+            if args.simulate:
+                with open(args.simulate, "rb") as ini_file:
+                    simulation_lines = split_lines(decode_ini_bytes(ini_file.read()))
+            else:
+                simulation_lines = generated_simulation_lines(get_patch_settings(args))
+            try:
+                frames = simulate_frames(SimulatedIni(simulation_lines), args.scenario, max(1, args.fps))
+            except ValueError as e:
+                print(f"Can't simulate: {e}")
+                return
+            print_simulation_report(summarize_simulation(frames))
+            return
+
+        if args.load_cost:
+            if args.root is not None:
+                if not os.path.isdir(args.root):
+                    print(f"Mods folder not found: {args.root}")
+                    return
+                root_directory = os.path.abspath(args.root)
+                with open_mod_catalog(root_directory, not args.no_catalog, dry_run=True) as catalog:
+                    folders = find_merged_mod_folders(root_directory, catalog)
+            else:
+                script_directory = os.path.dirname(os.path.abspath(__file__))
+                root_directory = os.path.dirname(script_directory)
+                folders = [script_directory] if any(is_merged_ini(os.path.join(script_directory, filename)) for filename in find_ini_files(script_directory)) else []
+            run_load_cost(root_directory, folders, args, os.path.abspath(args.library) if args.library else root_directory, max(0, args.top))
+            return
+
+        if args.serve is not None:
+            root_directory = os.path.abspath(args.root) if args.root else None
+            socket_path = args.serve or os.path.join(root_directory or os.path.dirname(os.path.abspath(__file__)), SERVER_SOCKET_FILENAME)
+            serve_mods(socket_path, root_directory, os.path.abspath(args.library) if args.library else None, not args.no_catalog)
+            return
+
+        if args.manifest is not None:
+            manifest_root = os.path.abspath(args.root or os.path.dirname(os.path.abspath(args.manifest)))
+            with open_mod_catalog(manifest_root, not args.no_catalog, args.dry_run) as catalog:
+                batch_results = run_manifest(args.manifest, manifest_root, args, catalog)
+            if args.dry_run and batch_results:
+                output_diffs([diff for result in batch_results if result.diffs for diff in result.diffs], args.diff_output)
+            elif batch_results:
+                print(f"Run again with --root {manifest_root} --revert to undo the changes.")
+            return
+
+        if args.root is not None:
+            if not os.path.isdir(args.root):
+                print(f"Mods folder not found: {args.root}")
+                return
+
+            if args.revert:
+                revert_all(root_directory=os.path.abspath(args.root))
+                return
+
+            if args.watch:
+                watch_mods(os.path.abspath(args.root), max(0.1, args.poll_interval), max(0.0, args.debounce), args.stream)
+                return
+
+            library_directory = os.path.abspath(args.library) if args.library else None
+            with open_mod_catalog(os.path.abspath(args.root), not args.no_catalog, args.dry_run) as catalog:
+                batch_results = run_batch(os.path.abspath(args.root), lambda folders: resolve_batch_settings(folders, args, catalog), max(1, args.jobs), args.stream, args.profile is not None, args.dry_run, library_directory, catalog=catalog)
+            if args.dry_run:
+                output_diffs([diff for result in batch_results if result.diffs for diff in result.diffs], args.diff_output)
+            elif batch_results:
+                print("Run again with --revert to undo the changes.")
+            return
+
+        script_directory = os.path.dirname(os.path.abspath(__file__))
+        if args.revert:
+            revert_all(script_directory=script_directory)
+            return
+
+        if args.watch:
+            watch_mods(script_directory, max(0.1, args.poll_interval), max(0.0, args.debounce), args.stream)
+            return
+
+        # Error checking
+        ini_files = get_ini_files(script_directory)
+
+        invalid_ini_files = [filename for filename in ini_files if not check_ini_file(os.path.join(script_directory, filename))]
+
+        if invalid_ini_files:
+            print("INFO: This script will only work on INI files generated by genshin_merge_mods.py")
+            print("Invalid INI files:")
+            for invalid_file in invalid_ini_files:
+                print(invalid_file)
+            return
+
+        # User inputs, the answers saved by an earlier run on this mod fill in what the flags don't set
+        cached_settings = load_cached_answers(script_directory, ini_files)
+        if cached_settings is not None:
+            print(f"Using the answers saved in {ANSWER_CACHE_FILENAME}, delete it to be asked again.")
+        settings = get_patch_settings(args, cached_settings)
+        if uses_detection_library(settings):
+            write_detection_library(os.path.abspath(args.library or os.path.dirname(script_directory)), args.dry_run)
+        if args.dry_run:
+            diffs = preview_ini_files(script_directory, ini_files, settings)
+            if not diffs:
+                print("All INI files are already up to date.")
+                return
+            output_diffs(diffs, args.diff_output)
+            return
+
+        written_files = patch_ini_files(script_directory, ini_files, settings, args.stream)
+        if not written_files:
+            save_cached_answers(script_directory, ini_files, settings)
+            print("All INI files are already up to date.")
+            return
+
+        print(f"Successfully added {settings.num_outfits} Underwater Outfits")
+        print(describe_outfit_dispatch(settings))
+
+        # The report covers the patching, not the time spent waiting at the prompt below
+        if args.profile is not None:
+            write_profile_report(args.profile)
+
+        # A run on saved answers asks nothing, not even this
+        if cached_settings is not None:
+            save_cached_answers(script_directory, ini_files, settings)
+            print("Run again with --revert to undo the changes.")
+            return
+
+        # Offer the option to revert the changes of this run
+        # The answers are saved for a patch that is kept
+        revert_changes = input("Do you want to revert changes? (yes/no):\n").strip().lower()
         if revert_changes in ["yes", "y"]:
-            for filename, backup_path in zip(ini_files, backup_paths):
-                ini_path = os.path.join(script_directory, filename)
-                restore_backup(ini_path, backup_path)
+            revert_ini_files(script_directory, written_files)
+        else:
+            save_cached_answers(script_directory, ini_files, settings)
 
     except KeyboardInterrupt:
         print("Script interrupted by user.")
 
+    except EOFError:
+        print("No answers to read. Give them as flags, or run the script in a terminal.")
+
     except ValueError:
         print("Invalid input. Please enter a valid number or key.\n")
 
+    finally:
+        if PROFILER is not None:
+            write_profile_report(args.profile, batch_results)
+
 if __name__ == "__main__":
     signal.signal(signal.SIGINT, signal.default_int_handler)
     main()
@@ -0,0 +1,364 @@
+#----------------------------------------------------------------------------------------#
+# DESCRIPTION: Times every stage of autoUnderwaterOutfit on generated merged INIs---------#
+#----------------------------------------------------------------------------------------#
+
+import os
+import sys
+import argparse
+import contextlib
+import io
+import json
+import platform
+import random
+import shutil
+import statistics
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import autoUnderwaterOutfit as auo
+
+BENCHMARK_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+BASELINE_PATH = os.path.join(BENCHMARK_DIRECTORY, "baseline.json")
+RESULTS_PATH = os.path.join(BENCHMARK_DIRECTORY, "results.json")
+
+CHARACTER = "RaidenShogun"
+PARTS = ("Head", "Body", "Dress", "Extra")
+
+# Where [Constants], [KeySwap] and [Present] sit in the generated INI
+LAYOUTS = ("standard", "keyswap_first", "present_last", "no_present")
+
+# (layout, line ending) generated for every variant count
+CASES = (
+    ("standard", "\n"),
+    ("keyswap_first", "\r\n"),
+    ("present_last", "\r\n"),
+    ("no_present", "\n"),
+)
+
+SETTINGS = auo.PatchSettings(
+    num_outfits=2,
+    swapvar_values=(1, 2),
+    key_toggle="VK_F7",
+    global_detection="n",
+    delay_in_seconds_end=9.75,
+    delay_in_seconds_start=0.0,
+    adjust_key_swap="y",
+)
+
+# Generator -------------------------------------------------------------------------------
+
+def random_hash(rng, digits=8):
+    return "".join(rng.choice("0123456789abcdef") for _ in range(digits))
+
+# A $swapvar switch over every variant, the way genshin_merge_mods.py writes its CommandLists
+def swapvar_switch(variant_count, lines_for_variant):
+    lines = []
+    for i in range(variant_count):
+        lines.append(f"if $swapvar == {i}" if i == 0 else f"else if $swapvar == {i}")
+        lines.extend(f"\t{line}" for line in lines_for_variant(i))
+    lines.append("endif")
+    return lines
+
+# Text of a merged INI with variant_count variants, laid out as layout
+def generate_merged_ini(variant_count, layout="standard", newline="\n", seed=0):
+    rng = random.Random(seed)
+    variants = ", ".join(f".\\{i}\\{CHARACTER}.ini" for i in range(variant_count))
+
+    constants = [
+        "[Constants]",
+        "global persist $swapvar = 0",
+        "global $active",
+        "global $creditinfo = 0",
+        "",
+    ]
+    keyswap = [
+        "[KeySwap]",
+        "condition = $active == 1",
+        "key = VK_DOWN",
+        "back = VK_UP",
+        "type = cycle",
+        "$swapvar = " + ",".join(map(str, range(variant_count))),
+        "$creditinfo = 0",
+        "",
+    ]
+    present = [
+        "[Present]",
+        "post $active = 0",
+        "run = CommandListCreditInfo",
+        "",
+    ]
+    credit_info = [
+        "[CommandListCreditInfo]",
+        "if $creditinfo == 0 && $active == 1",
+        "\tpre Resource\\ShaderFixes\\help.ini\\Notification = ResourceNotification",
+        "\tpre $creditinfo = 1",
+        "endif",
+        "",
+    ]
+
+    overrides = [
+        "; Overrides ---------------------------",
+        "",
+        f"[TextureOverride{CHARACTER}Position]",
+        f"hash = {random_hash(rng)}",
+        f"run = CommandList{CHARACTER}Position",
+        "$active = 1",
+        "",
+        f"[TextureOverride{CHARACTER}Blend]",
+        f"hash = {random_hash(rng)}",
+        f"run = CommandList{CHARACTER}Blend",
+        "",
+    ]
+    first_index = 0
+    for part in PARTS:
+        overrides.extend([
+            f"[TextureOverride{CHARACTER}{part}]",
+            f"hash = {random_hash(rng)}",
+            f"match_first_index = {first_index}",
+            f"run = CommandList{CHARACTER}{part}",
+            "",
+        ])
+        first_index += rng.randint(1000, 30000)
+
+    command_lists = ["; CommandList -------------------------", ""]
+    command_lists.append(f"[CommandList{CHARACTER}Position]")
+    command_lists.extend(swapvar_switch(variant_count, lambda i: [f"vb0 = Resource{CHARACTER}Position.{i}"]))
+    command_lists.append("")
+    command_lists.append(f"[CommandList{CHARACTER}Blend]")
+    command_lists.extend(swapvar_switch(variant_count, lambda i: [
+        f"vb1 = Resource{CHARACTER}Blend.{i}",
+        "handling = skip",
+        "draw = 21916,0",
+    ]))
+    command_lists.append("")
+    for part in PARTS:
+        command_lists.append(f"[CommandList{CHARACTER}{part}]")
+        command_lists.extend(swapvar_switch(variant_count, lambda i, part=part: [
+            f"ib = Resource{CHARACTER}{part}IB.{i}",
+            f"ps-t0 = Resource{CHARACTER}{part}Diffuse.{i}",
+            f"ps-t1 = Resource{CHARACTER}{part}LightMap.{i}",
+        ]))
+        command_lists.append("")
+
+    resources = ["; Resources ---------------------------", ""]
+    for i in range(variant_count):
+        resources.append(f"; .\\{i}\\{CHARACTER}.ini")
+        for name, stride in (("Position", 40), ("Blend", 32)):
+            resources.extend([
+                f"[Resource{CHARACTER}{name}.{i}]",
+                "type = Buffer",
+                f"stride = {stride}",
+                f"filename = .\\{i}\\{CHARACTER}{name}.buf",
+                "",
+            ])
+        for part in PARTS:
+            resources.extend([
+                f"[Resource{CHARACTER}{part}IB.{i}]",
+                "type = Buffer",
+                "format = DXGI_FORMAT_R32_UINT",
+                f"filename = .\\{i}\\{CHARACTER}{part}.ib",
+                "",
+                f"[Resource{CHARACTER}{part}Diffuse.{i}]",
+                f"filename = .\\{i}\\{CHARACTER}{part}Diffuse.dds",
+                "",
+                f"[Resource{CHARACTER}{part}LightMap.{i}]",
+                f"filename = .\\{i}\\{CHARACTER}{part}LightMap.dds",
+                "",
+            ])
+
+    lines = [f"; Merged Mod: {variants}", "", "; Constants ---------------------------", ""]
+    if layout == "keyswap_first":
+        lines += keyswap + constants + present + credit_info
+    elif layout == "present_last":
+        lines += constants + keyswap + credit_info
+    elif layout == "no_present":
+        lines += constants + keyswap + credit_info
+    else:
+        lines += constants + keyswap + present + credit_info
+
+    lines += overrides + command_lists + resources
+    if layout == "present_last":
+        lines += present
+    lines.append("; .ini generated by GIMI (Genshin-Impact-Model-Importer)")
+
+    return newline.join(lines) + newline
+
+def write_merged_ini(ini_path, variant_count, layout, newline):
+    with open(ini_path, "w", newline="") as ini_file:
+        ini_file.write(generate_merged_ini(variant_count, layout, newline))
+
+# Stages ----------------------------------------------------------------------------------
+# Every stage is (name, setup, run): setup gets a fresh folder holding the generated INI and
+# returns the argument for run, only run is timed.
+
+def rendered_lines(ini_path):
+    keyswap = auo.build_keyswap_index([os.path.basename(ini_path)], os.path.dirname(ini_path)).get(os.path.basename(ini_path), auo.EMPTY_KEYSWAP)
+    outfit_select_values = ",".join(map(str, range(SETTINGS.num_outfits)))
+    return auo.render_underwater_outfit_lines(False, SETTINGS.key_toggle, SETTINGS.num_outfits, SETTINGS.swapvar_values, outfit_select_values, keyswap.key_swap, keyswap.key_back, keyswap.key_swap_type, keyswap.value_swap, SETTINGS.delay_in_seconds_end, SETTINGS.delay_in_seconds_start)
+
+def load_document(ini_path):
+    lines_to_add_constants, lines_to_add_present = rendered_lines(ini_path)
+    return auo.IniDocument.load(ini_path), lines_to_add_constants, lines_to_add_present
+
+def patch_once(ini_path, settings=SETTINGS, stream=False):
+    auo.patch_ini_files(os.path.dirname(ini_path), [os.path.basename(ini_path)], settings, stream)
+    return ini_path
+
+def load_patched_document(ini_path):
+    patch_once(ini_path)
+    ini_document, lines_to_add_constants, lines_to_add_present = load_document(ini_path)
+    return ini_document, ini_document.find_patched_blocks(), lines_to_add_constants, lines_to_add_present
+
+def run_reapply(state):
+    ini_document, patched_blocks, lines_to_add_constants, lines_to_add_present = state
+    changed_constants = [line.replace(SETTINGS.key_toggle, "VK_F8") for line in lines_to_add_constants]
+    auo.reapply_underwater_outfit(ini_document, patched_blocks, changed_constants, lines_to_add_present, list(SETTINGS.swapvar_values), SETTINGS.adjust_key_swap)
+
+def run_backup_and_restore(ini_path):
+    auo.restore_backup(ini_path, auo.create_backup(ini_path))
+
+STAGES = (
+    ("check_ini_file", lambda ini_path: ini_path, lambda ini_path: auo.check_ini_file(ini_path, verbose=False)),
+    ("find_keyswap_values", lambda ini_path: ini_path, lambda ini_path: auo.find_keyswap_values([os.path.basename(ini_path)], os.path.dirname(ini_path))),
+    ("load", lambda ini_path: ini_path, auo.IniDocument.load),
+    ("add_lines_to_section", load_document, lambda state: state[0].add_lines_to_section(auo.CONSTANTS_SECTION, state[1])),
+    ("ensure_present_section_exists", load_document, lambda state: state[0].ensure_present_section_exists(auo.PRESENT_SECTION, state[2])),
+    ("remove_swapvar_values", load_document, lambda state: state[0].remove_swapvar_values(list(SETTINGS.swapvar_values))),
+    ("modify_condition_value", load_document, lambda state: state[0].modify_condition_value(auo.CONDITION)),
+    ("apply_underwater_outfit", load_document, lambda state: auo.apply_underwater_outfit(state[0], state[1], state[2], list(SETTINGS.swapvar_values), SETTINGS.adjust_key_swap)),
+    ("reapply_underwater_outfit", load_patched_document, run_reapply),
+    ("patch_ini_files", lambda ini_path: ini_path, patch_once),
+    ("patch_ini_files_stream", lambda ini_path: ini_path, lambda ini_path: patch_once(ini_path, stream=True)),
+    ("revert_ini_files", patch_once, lambda ini_path: auo.revert_ini_files(os.path.dirname(ini_path), [os.path.basename(ini_path)])),
+    ("backup_and_restore", lambda ini_path: ini_path, run_backup_and_restore),
+)
+
+# min and median seconds of repeat runs, each on a fresh copy of the INI
+def time_stage(source_path, setup, run, repeat):
+    timings = []
+    for _ in range(repeat):
+        folder = tempfile.mkdtemp(prefix="auo-bench-")
+        try:
+            ini_path = os.path.join(folder, os.path.basename(source_path))
+            shutil.copyfile(source_path, ini_path)
+            with contextlib.redirect_stdout(io.StringIO()):
+                state = setup(ini_path)
+                start = time.perf_counter()
+                run(state)
+                timings.append(time.perf_counter() - start)
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    return {"min": min(timings), "median": statistics.median(timings)}
+
+def run_benchmarks(variant_counts, repeat, stage_names=None):
+    results = {}
+    corpus_directory = tempfile.mkdtemp(prefix="auo-corpus-")
+    try:
+        for variant_count in variant_counts:
+            for layout, newline in CASES:
+                newline_name = "crlf" if newline == "\r\n" else "lf"
+                case_name = f"{variant_count}v-{layout}-{newline_name}"
+                source_path = os.path.join(corpus_directory, case_name, f"{CHARACTER}.ini")
+                os.makedirs(os.path.dirname(source_path))
+                write_merged_ini(source_path, variant_count, layout, newline)
+
+                case = {"bytes": os.path.getsize(source_path), "stages": {}}
+                for stage_name, setup, run in STAGES:
+                    if stage_names and stage_name not in stage_names:
+                        continue
+                    case["stages"][stage_name] = time_stage(source_path, setup, run, repeat)
+
+                results[case_name] = case
+                print(f"{case_name}: {case['bytes']} bytes, {sum(timing['min'] for timing in case['stages'].values()) * 1000:.1f} ms over all stages")
+    finally:
+        shutil.rmtree(corpus_directory, ignore_errors=True)
+
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "repeat": repeat,
+        "results": results,
+    }
+
+# Baseline --------------------------------------------------------------------------------
+
+# Stages slower than threshold x baseline (and by more than min_delta seconds, below that it's noise)
+def compare_with_baseline(report, baseline, threshold, min_delta):
+    regressions = []
+    for case_name, case in report["results"].items():
+        baseline_case = baseline["results"].get(case_name)
+        if baseline_case is None:
+            continue
+        for stage_name, timing in case["stages"].items():
+            baseline_timing = baseline_case["stages"].get(stage_name)
+            if baseline_timing is None:
+                continue
+            ratio = timing["min"] / baseline_timing["min"] if baseline_timing["min"] else float("inf")
+            if ratio > threshold and timing["min"] - baseline_timing["min"] > min_delta:
+                regressions.append((case_name, stage_name, baseline_timing["min"], timing["min"], ratio))
+    return regressions
+
+def print_summary(report):
+    stage_names = [stage_name for stage_name, _, _ in STAGES]
+    for case_name, case in report["results"].items():
+        print(f"\n{case_name} ({case['bytes']} bytes)")
+        for stage_name in stage_names:
+            timing = case["stages"].get(stage_name)
+            if timing is not None:
+                print(f"  {stage_name:<30} {timing['min'] * 1000:10.3f} ms  (median {timing['median'] * 1000:.3f} ms)")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark autoUnderwaterOutfit on generated merged INIs.")
+    parser.add_argument("--variants", nargs="+", type=int, default=[4, 64, 1024], help="Variant counts of the generated INIs.")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per stage, the fastest one counts.")
+    parser.add_argument("--stages", nargs="+", choices=[stage_name for stage_name, _, _ in STAGES], help="Only time these stages.")
+    parser.add_argument("--output", type=str, default=RESULTS_PATH, help="Where to write the JSON results.")
+    parser.add_argument("--baseline", type=str, default=BASELINE_PATH, help="Baseline JSON to compare with.")
+    parser.add_argument("--save-baseline", action="store_true", help="Store these results as the new baseline instead of comparing.")
+    parser.add_argument("--threshold", type=float, default=1.5, help="Slowdown factor against the baseline that counts as a regression.")
+    parser.add_argument("--min-delta", type=float, default=0.002, help="Slowdowns smaller than this many seconds are ignored.")
+    parser.add_argument("--generate", type=str, help="Only write one generated INI to this path (uses the first --variants count).")
+    parser.add_argument("--layout", type=str, choices=LAYOUTS, default="standard", help="Layout of the INI written with --generate.")
+    parser.add_argument("--crlf", action="store_true", help="Use CRLF line endings for the INI written with --generate.")
+
+    args = parser.parse_args()
+
+    if args.generate is not None:
+        write_merged_ini(args.generate, args.variants[0], args.layout, "\r\n" if args.crlf else "\n")
+        print(f"Wrote {args.generate}")
+        return 0
+
+    report = run_benchmarks(args.variants, max(1, args.repeat), args.stages)
+    print_summary(report)
+
+    with open(args.output, "w", encoding="utf-8") as output_file:
+        json.dump(report, output_file, indent=2)
+    print(f"\nResults written to {args.output}")
+
+    if args.save_baseline:
+        shutil.copyfile(args.output, args.baseline)
+        print(f"Baseline saved to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}, run with --save-baseline to create one.")
+        return 0
+
+    with open(args.baseline, "r", encoding="utf-8") as baseline_file:
+        baseline = json.load(baseline_file)
+
+    regressions = compare_with_baseline(report, baseline, args.threshold, args.min_delta)
+    if not regressions:
+        print(f"No regressions against {args.baseline}")
+        return 0
+
+    print(f"\nRegressions against {args.baseline}:")
+    for case_name, stage_name, baseline_seconds, seconds, ratio in regressions:
+        print(f"  {case_name} {stage_name}: {baseline_seconds * 1000:.3f} ms -> {seconds * 1000:.3f} ms ({ratio:.2f}x)")
+    return 1
+
+if __name__ == "__main__":
+    sys.exit(main())